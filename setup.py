@@ -14,10 +14,13 @@ pkg_author_email = 'm.richardson@ed.ac.uk'
 pkg_classifiers = [
             'Development Status :: 5 - Production/Stable',
             'License :: OSI Approved :: GNU Affero General Public License v3 or later (AGPLv3+)',
-            'Programming Language :: Python :: 2.6',
             'Programming Language :: Python :: 3',
+            'Programming Language :: Python :: 3 :: Only',
             ]
 
+# contextvars (used to redirect output per thread) needs 3.7
+python_requires = '>=3.7'
+
 install_requires = ['rl']
 
 # Neither OSX nor Windows ship with GNU readline
@@ -43,6 +46,7 @@ def main():
         include_package_data=True,
         package_data = {'': ['LICENSE']},
         install_requires=install_requires,
+        python_requires=python_requires,
         test_suite="{0}.{1}".format(pkg_name, "tests"),
         )
 
@@ -6,11 +6,32 @@ Shellac
 shellac is an alternative to the standard python library `cmd <http://docs.python.org/2/library/cmd.html>`_ which aims to offer an alternative approach to nesting commands.
 """
 
+import bisect
+import collections
+import contextvars
+import copy
+import heapq
+import importlib
+import io
+import itertools
+import os
+import queue
+import re
+import shlex
 import sys
+import threading
+import time
 import rl
 import rl.readline as readline
 import inspect
-from functools import wraps
+import types
+import weakref
+from functools import partial, wraps, update_wrapper
+from shellac import fuzzy
+from shellac.audit import AuditLog
+from shellac.history import History
+from shellac.pager import Pager, PagerQuit
+from shellac.record import Recorder, Tee
 
 
 def completer(func):
@@ -27,7 +48,423 @@ def completer(func):
     return inner_completer
 
 
-def members(obj, prefix='do_'):
+def warmable(func):
+    """Mark a completion function as safe to call ahead of time.
+
+    When the shell warms up (see :meth:`Shellac.warm`), warmable completion
+    functions are called with an empty token in the background, so that any
+    caches they keep are filled before the first completion.
+    """
+
+    func.warmable = True
+    return func
+
+
+def timeout(seconds):
+    """Limit the time the decorated do_*() callable may run for.
+
+    When the time is up, the shell reports the timeout and moves on to the
+    next command, and the command's :class:`CancelToken` is cancelled. A
+    timeout of None disables the shell's *command_timeout* for the command.
+
+    :type seconds: float
+    :param seconds: Maximum run time in seconds.
+    """
+
+    def inner_timeout(obj):
+        obj.timeout = seconds
+        return obj
+    return inner_timeout
+
+
+def serial(obj):
+    """Mark a do_*() callable as one which must not run concurrently with
+    other commands when a script is run in parallel (see
+    :mod:`shellac.parallel`)."""
+
+    obj.serial = True
+    return obj
+
+
+class Cancelled(Exception):
+    """Raised by CancelToken.check() when a command has been cancelled."""
+
+
+class CancelToken(object):
+    """Tells a running command that it should stop.
+
+    Commands which run with a timeout can check their token (see
+    :func:`current_token` and :func:`cancelled`) and finish early once it has
+    been cancelled.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        """Raise Cancelled if the token has been cancelled."""
+
+        if self.event.is_set():
+            raise Cancelled()
+
+
+# The CancelToken of the command running in the current thread or context
+_current_token = contextvars.ContextVar('shellac_token', default=None)
+
+
+def current_token():
+    """Return the CancelToken for the running command, or None if the command
+    has no timeout."""
+
+    return _current_token.get()
+
+
+def cancelled():
+    """Return True if the running command has been cancelled."""
+
+    token = _current_token.get()
+    return token is not None and token.cancelled
+
+
+class Batch(object):
+    """How to merge calls of a @batchable command (see :func:`batchable`)."""
+
+    def __init__(self, handler, max_batch, max_delay):
+        self.handler = handler
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+
+def batchable(bulk_handler, max_batch=100, max_delay=0.5):
+    """Allow consecutive calls of the decorated do_*() callable to be merged.
+
+    When lines are run from a script (see :meth:`Shellac.runscript`) or from
+    cmdqueue, consecutive lines which call the decorated command are
+    collected and passed to *bulk_handler* in a single call, as a list of
+    argument strings. The handler returns a list with one result per line
+    (or None), and postcmd() is called for each line with its result; a
+    ValueError is raised if the number of results is wrong. The handler
+    runs with the command's timeout. Lines are not merged if middleware
+    applies to the command (see :meth:`Shellac.use`).
+
+    :type bulk_handler: callable
+    :param bulk_handler: Called with a list of argument strings.
+
+    :type max_batch: int
+    :param max_batch: Maximum number of lines merged into one call.
+
+    :type max_delay: float
+    :param max_delay: Maximum time (in seconds) to wait for more lines
+                      before running a partial batch.
+    """
+
+    def inner_batchable(obj):
+        obj.batch = Batch(getattr(bulk_handler, '__func__', bulk_handler),
+                          max_batch, max_delay)
+        return obj
+    return inner_batchable
+
+
+class ArgumentError(ValueError):
+    """Raised when a command line doesn't match a command's arguments.
+
+    :ivar argument: Name of the argument at fault (or None).
+    :ivar value: The offending text (or None).
+    :ivar message: Description of the problem.
+    :ivar usage: Usage string for the command's arguments.
+    :ivar command: The command path, e.g. 'user add' (set by onecmd()).
+    """
+
+    def __init__(self, message, argument=None, value=None, usage=None):
+        super(ArgumentError, self).__init__(message)
+        self.message = message
+        self.argument = argument
+        self.value = value
+        self.usage = usage
+        self.command = None
+
+
+class Argument(object):
+    """A positional argument or option of a command (see :func:`arguments`).
+
+    Names starting with '-' make an option (e.g. ``'--count', '-n'``),
+    otherwise a positional argument. The value is passed to the command as
+    a keyword argument named after the first long name.
+
+    :type type: callable
+    :param type: Converts the string value (e.g. int). bool makes an option
+                 a flag which takes no value.
+
+    :param default: Value if the argument isn't given. Positional arguments
+                    without a default are required.
+
+    :type choices: list or callable
+    :param choices: Allowed values, or a function which is called with a
+                    prefix and returns candidates to complete with.
+
+    :type many: boolean
+    :param many: The last positional argument may take any number of values
+                 (including none), which are passed as a list.
+
+    :type help: string
+    :param help: Description shown in the command's help.
+    """
+
+    def __init__(self, *names, **options):
+        self.names = names
+        self.option = names[0].startswith('-')
+        self.required = not self.option and 'default' not in options and \
+            not options.get('many')
+        self.type = options.pop('type', str)
+        self.default = options.pop('default', None)
+        self.choices = options.pop('choices', None)
+        self.many = options.pop('many', False)
+        self.help = options.pop('help', None)
+        if options:
+            raise TypeError("unknown options: " + ", ".join(sorted(options)))
+        self.flag = self.option and self.type is bool
+        longest = max(names, key=len)
+        self.dest = longest.lstrip('-').replace('-', '_')
+        if self.flag and self.default is None:
+            self.default = False
+        if self.many and self.default is None:
+            self.default = []
+
+    def metavar(self):
+        return self.dest.upper()
+
+    def label(self):
+        """Return the argument as shown in help, e.g. '--count, -n COUNT'."""
+
+        if not self.option:
+            return self.metavar()
+        names = ', '.join(self.names)
+        return names if self.flag else names + ' ' + self.metavar()
+
+    def convert(self, value, usage):
+        """Return the value converted to the argument's type."""
+
+        try:
+            result = self.type(value)
+        except (TypeError, ValueError):
+            raise ArgumentError("invalid {0} value for {1}: {2!r}".format(
+                getattr(self.type, '__name__', 'argument'), self.names[0],
+                value), self.dest, value, usage)
+        if isinstance(self.choices, (list, tuple, set, frozenset)) and \
+                result not in self.choices:
+            raise ArgumentError("invalid choice for {0}: {1!r}".format(
+                self.names[0], value), self.dest, value, usage)
+        return result
+
+    def candidates(self, token):
+        """Return completion candidates for a value starting with token."""
+
+        if callable(self.choices):
+            return Shellac.call_static(self.choices, token)
+        if self.choices is not None:
+            return complete_list([str(c) for c in self.choices], token)
+        return iter(())
+
+
+class Schema(object):
+    """The compiled arguments of a command (see :func:`arguments`)."""
+
+    def __init__(self, args):
+        self.args = args
+        self.options = {}
+        self.positional = []
+        for arg in args:
+            if arg.option:
+                for name in arg.names:
+                    self.options[name] = arg
+            else:
+                self.positional.append(arg)
+        for arg in self.positional[:-1]:
+            if arg.many:
+                raise TypeError("only the last positional argument can "
+                                "take many values")
+        self.defaults = [(arg.dest, arg.default) for arg in args
+                         if not arg.required]
+        self.required = [arg for arg in self.positional if arg.required]
+        self.usage = ' '.join(
+            ['[{0}]'.format(arg.names[0]) if arg.flag else
+             '[{0} {1}]'.format(arg.names[0], arg.metavar())
+             for arg in args if arg.option] +
+            [arg.metavar() if arg.required else
+             '[{0}...]'.format(arg.metavar()) if arg.many else
+             '[{0}]'.format(arg.metavar())
+             for arg in self.positional])
+
+    def help(self):
+        """Return a description of the arguments which have help, or ''."""
+
+        described = [arg for arg in self.args if arg.help]
+        if not described:
+            return ''
+        width = max(len(arg.label()) for arg in described)
+        return "Arguments:\n" + "\n".join(
+            "  {0:<{1}}  {2}".format(arg.label(), width, arg.help)
+            for arg in described)
+
+    @staticmethod
+    def _is_option(token):
+        if not token.startswith('-') or token == '-':
+            return False
+        try:
+            float(token)
+        except ValueError:
+            return True
+        return False
+
+    def parse(self, line):
+        """Parse an argument string into a dict of keyword arguments.
+
+        :raises ArgumentError: if the string doesn't match the arguments.
+        """
+
+        try:
+            tokens = shlex.split(line)
+        except ValueError as exc:
+            raise ArgumentError(str(exc), None, line, self.usage)
+        values = dict((dest, list(default) if isinstance(default, list)
+                       else default) for dest, default in self.defaults)
+        positional = 0
+        options = True
+        tokens = iter(tokens)
+        for token in tokens:
+            if options and token == '--':
+                options = False
+                continue
+            if options and self._is_option(token):
+                name, equals, value = token.partition('=')
+                arg = self.options.get(name)
+                if arg is None:
+                    raise ArgumentError("unknown option " + name, None,
+                                        token, self.usage)
+                if arg.flag:
+                    if equals:
+                        raise ArgumentError(name + " takes no value",
+                                            arg.dest, token, self.usage)
+                    values[arg.dest] = True
+                    continue
+                if not equals:
+                    value = next(tokens, None)
+                    if value is None:
+                        raise ArgumentError(name + " needs a value",
+                                            arg.dest, None, self.usage)
+                values[arg.dest] = arg.convert(value, self.usage)
+                continue
+            if positional >= len(self.positional):
+                raise ArgumentError("unexpected argument " + token, None,
+                                    token, self.usage)
+            arg = self.positional[positional]
+            if arg.many:
+                values[arg.dest].append(arg.convert(token, self.usage))
+            else:
+                values[arg.dest] = arg.convert(token, self.usage)
+                positional += 1
+        for arg in self.required:
+            if arg.dest not in values:
+                raise ArgumentError("missing " + arg.metavar(), arg.dest,
+                                    None, self.usage)
+        return values
+
+    def complete(self, tokens):
+        """Return completion candidates for the last of the given argument
+        tokens."""
+
+        token = tokens[-1]
+        positional = 0
+        pending = None
+        options = True
+        for previous in tokens[:-1]:
+            if pending is not None:
+                pending = None
+            elif options and previous == '--':
+                options = False
+            elif options and self._is_option(previous):
+                arg = self.options.get(previous.partition('=')[0])
+                if arg is not None and not arg.flag and '=' not in previous:
+                    pending = arg
+            elif positional < len(self.positional) and \
+                    not self.positional[positional].many:
+                positional += 1
+        if pending is not None:
+            return pending.candidates(token)
+        if options and token.startswith('-'):
+            return complete_list(sorted(self.options), token)
+        if positional < len(self.positional):
+            return self.positional[positional].candidates(token)
+        return iter(())
+
+
+def arguments(*args):
+    """Declare the arguments of the decorated do_*() callable.
+
+    The arguments are compiled once, when the command is defined. Each time
+    the command is run, its argument string is parsed (with shell-style
+    quoting) and the values are passed as keyword arguments::
+
+        @staticmethod
+        @shellac.arguments(Argument('name', choices=list_users),
+                           Argument('--count', '-n', type=int, default=1),
+                           Argument('--force', type=bool))
+        def do_add(name, count, force):
+            ...
+
+    Arguments which don't match raise :class:`ArgumentError`, which is
+    passed to :meth:`Shellac.argument_error`. Completion of options, and of
+    values with *choices*, comes from the same declaration, and the *help*
+    of the arguments is added to the command's help.
+
+    :type args: Argument
+    :param args: The arguments, in order.
+    """
+
+    schema = Schema(args)
+
+    def inner_arguments(func):
+        @wraps(func)
+        def parsing(*params):
+            return func(*params[:-1], **schema.parse(params[-1]))
+        parsing.schema = schema
+        described = schema.help()
+        if described:
+            doc = inspect.cleandoc(func.__doc__) if func.__doc__ else ''
+            parsing.__doc__ = doc + "\n\n" + described if doc else described
+        return parsing
+    return inner_arguments
+
+
+def _reader(lines):
+    """Read lines from an iterable in a background thread.
+
+    :return: a function taking a timeout, which returns the next line
+             (without its line ending), None at the end of the input, or
+             raises queue.Empty if no line arrived in time.
+    """
+
+    lines_queue = queue.Queue(1000)
+
+    def read():
+        for line in lines:
+            lines_queue.put(line.rstrip('\r\n'))
+        lines_queue.put(None)
+
+    thread = threading.Thread(target=read, name="shellac reader")
+    thread.daemon = True
+    thread.start()
+    return lambda timeout: lines_queue.get(timeout=timeout)
+
+
+def members(obj, prefix='do_', start=''):
     """Return a list of members of the given class which start with a given
     prefix.
 
@@ -37,10 +474,206 @@ def members(obj, prefix='do_'):
     :type prefix: string
     :param prefix: The prefix which members of the given class must start with.
 
+    :type start: string
+    :param start: Only return names (without the prefix) which start with this.
+
     :return: list
     """
 
-    return (f[0][len(prefix):] for f in inspect.getmembers(obj) if f[0].startswith(prefix))
+    if isinstance(obj, Group):
+        return obj.names(start) if prefix == 'do_' else iter(())
+    if isinstance(obj, Session):
+        obj = obj.shell
+    if inspect.isclass(obj):
+        names = _class_names(obj)
+    elif type(obj).__dir__ is object.__dir__:
+        names = _class_names(type(obj))
+        own = [name for name in getattr(obj, '__dict__', ())
+               if name.startswith(prefix) and name not in names]
+        if own:
+            names = sorted(names + tuple(own))
+    else:
+        names = sorted(dir(obj))
+    start = prefix + start
+    return (name[len(prefix):] for name in names if name.startswith(start))
+
+
+# Sorted attribute names of the classes seen by members(), with the
+# attribute names of each class in their MRO when they were listed
+_member_names = weakref.WeakKeyDictionary()
+
+
+def _class_names(klass):
+    """Return the sorted attribute names of a class, cached until an
+    attribute is added to or removed from the class or one of its bases."""
+
+    own = tuple(tuple(vars(base)) for base in klass.__mro__
+                if base is not object)
+    cached = _member_names.get(klass)
+    if cached is not None and cached[0] == own:
+        return cached[1]
+    names = tuple(sorted(dir(klass)))
+    _member_names[klass] = (own, names)
+    return names
+
+
+class Group(object):
+    """A command group whose subcommands are supplied at runtime.
+
+    Use a Group in place of a nested do_*() class when the subcommands
+    mirror data, e.g. one subcommand per site. Children are only created
+    when they are used (by dispatch, completion or help), and are then
+    treated exactly like static do_*() members::
+
+        class MyShell(Shellac):
+            do_site = Group(list_sites, Site, doc="Manage sites.")
+
+    :type names: callable
+    :param names: Called with a prefix; returns an iterable of the names of
+                  the children which start with it.
+
+    :type child: callable
+    :param child: Called with a name; returns the child command (a callable,
+                  an object or class with do_*() members, or another Group),
+                  or None if there is no such child.
+
+    :type doc: string
+    :param doc: Help text for the group.
+    """
+
+    def __init__(self, names, child, doc=None):
+        self._names = names
+        self._child = child
+        self._children = {}
+        # Always set, so that without doc there is no help rather than
+        # the Group class docstring
+        self.__doc__ = doc
+
+    def __getattr__(self, name):
+        if not name.startswith('do_'):
+            raise AttributeError(name)
+        key = name[3:]
+        try:
+            return self._children[key]
+        except KeyError:
+            pass
+        child = self._child(key)
+        if child is None:
+            raise AttributeError(name)
+        self._children[key] = child
+        return child
+
+    def names(self, prefix=''):
+        """Return the names of the children which start with prefix."""
+
+        return self._names(prefix)
+
+
+class Alias(object):
+    """A compiled alias or macro (see :meth:`Shellac.alias`).
+
+    The expansion is split into commands at ';' once, when the alias is
+    defined. ``$1`` ... ``$9`` in the expansion are replaced by the words
+    of the arguments given to the alias, and ``$*`` by all of them. If
+    there are no such parameters, the arguments are appended to the last
+    command.
+
+    :type name: string
+    :param name: The word which is expanded.
+
+    :type expansion: string
+    :param expansion: One or more command lines, separated by ';'.
+    """
+
+    _parameter = re.compile(r'\$(\d|\*)')
+
+    def __init__(self, name, expansion):
+        if not name or name.split() != [name]:
+            raise ValueError("invalid alias name: {0!r}".format(name))
+        self.name = name
+        self.expansion = expansion.strip()
+        self.commands = [command.strip()
+                         for command in self.expansion.split(';')
+                         if command.strip()]
+        if not self.commands:
+            raise ValueError("empty alias: {0}".format(name))
+        self.parameters = any(self._parameter.search(command)
+                              for command in self.commands)
+
+    def expand(self, args):
+        """Return the command lines the alias expands to."""
+
+        if not self.parameters:
+            if not args:
+                return list(self.commands)
+            return self.commands[:-1] + [self.commands[-1] + ' ' + args]
+        words = args.split()
+
+        def parameter(match):
+            if match.group(1) == '*':
+                return args
+            index = int(match.group(1))
+            return words[index - 1] if 0 < index <= len(words) else ''
+        return [self._parameter.sub(parameter, command)
+                for command in self.commands]
+
+
+def _qualname_lookup(module, qualname):
+    """Find an object in a module by its qualified name, or return None.
+
+    Objects are read from the class and module dictionaries, so that
+    staticmethod objects are returned as they are.
+    """
+
+    obj = module
+    for part in qualname.split('.'):
+        try:
+            obj = vars(obj)[part]
+        except (KeyError, TypeError):
+            return None
+    return obj
+
+
+def _merge_completions(completions, token):
+    """Merge the candidates from several completion functions into one
+    sorted stream without duplicates.
+
+    A single completion function's candidates are returned as they are,
+    and read lazily. When there are several, those with a true *sorted*
+    attribute (such as :class:`shellac.mapped.MappedCandidates`) are read
+    lazily; the output of the others is sorted first.
+
+    :return: iterable
+    """
+
+    if len(completions) == 1:
+        return Shellac.call_static(completions[0], token)
+    streams = []
+    for func in completions:
+        stream = Shellac.call_static(func, token)
+        if not getattr(getattr(func, '__func__', func), 'sorted', False):
+            stream = sorted(stream)
+        streams.append(stream)
+    return (match for match, _ in itertools.groupby(heapq.merge(*streams)))
+
+
+# True while completing without readline (see Shellac.complete_lines())
+_detached = contextvars.ContextVar('shellac_detached', default=False)
+
+
+def set_append_character(append_character):
+    """Set the character readline appends to a single completion.
+
+    Completion functions should call this rather than setting
+    rl.completion.append_character, since it leaves readline alone when
+    completions are requested through :meth:`Shellac.complete_line`.
+
+    :type append_character: string
+    :param append_character: completion character to append (see rl.completion.append_character)
+    """
+
+    if not _detached.get():
+        rl.completion.append_character = append_character
 
 
 def complete_list(names, token, append_character=" "):
@@ -58,10 +691,403 @@ def complete_list(names, token, append_character=" "):
     :return: generator
     """
 
-    rl.completion.append_character = append_character
+    set_append_character(append_character)
     return (x for x in names if x.startswith(token))
 
 
+# The stream print() should write to in the current thread or context
+_context_stdout = contextvars.ContextVar('shellac_stdout', default=None)
+
+
+class _StdoutProxy(object):
+    """Stand-in for sys.stdout which writes to the stream set for the current
+    context by redirect_stdout(), or to the original sys.stdout."""
+
+    def __init__(self, default):
+        self.default = default
+
+    def _stream(self):
+        stream = _context_stdout.get()
+        return self.default if stream is None else stream
+
+    def write(self, data):
+        return self._stream().write(data)
+
+    def flush(self):
+        return self._stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream(), name)
+
+
+class redirect_stdout(object):
+    """Context manager which sends sys.stdout to another stream, for the
+    current thread (or asyncio task) only.
+
+    Unlike :func:`contextlib.redirect_stdout`, this can be used by many
+    threads at once, for example to send the output of print() in do_*()
+    commands to the client which ran them.
+
+    :type stream: File-like object
+    :param stream: Stream to write to.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.token = None
+
+    def __enter__(self):
+        if not isinstance(sys.stdout, _StdoutProxy):
+            sys.stdout = _StdoutProxy(sys.stdout)
+        self.token = _context_stdout.set(self.stream)
+        return self.stream
+
+    def __exit__(self, *exc):
+        _context_stdout.reset(self.token)
+        return False
+
+
+def _real_stdout():
+    """Return the stream sys.stdout currently writes to."""
+
+    if isinstance(sys.stdout, _StdoutProxy):
+        return sys.stdout._stream()
+    return sys.stdout
+
+
+class _BufferPool(object):
+    """A pool of StringIO buffers for capturing command output, so that
+    buffers are reused rather than created for every command.
+
+    :type size: int
+    :param size: Most buffers kept.
+
+    :type max_chars: int
+    :param max_chars: Buffers which held more output than this are
+                      dropped rather than kept.
+    """
+
+    def __init__(self, size=32, max_chars=1 << 20):
+        self.buffers = []
+        self.size = size
+        self.max_chars = max_chars
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.buffers:
+                return self.buffers.pop()
+        return io.StringIO()
+
+    def put(self, buffer):
+        if buffer.tell() > self.max_chars:
+            return
+        buffer.seek(0)
+        buffer.truncate()
+        with self.lock:
+            if len(self.buffers) < self.size:
+                self.buffers.append(buffer)
+
+# Commands left running after their timeout, which may still write output
+_abandoned = contextvars.ContextVar('shellac_abandoned', default=None)
+
+
+#: The outcome of :meth:`Shellac.execute`: the command's stop flag, its
+#: output, the exception it raised (or None) and its run time in seconds.
+Result = collections.namedtuple('Result', 'stop output error duration')
+
+
+def cached(ttl=60, maxsize=128):
+    """Cache the results of the decorated do_*() callable.
+
+    Results are cached by argument string, for up to *ttl* seconds, and the
+    least recently used results are discarded once there are more than
+    *maxsize*. Anything the command writes to sys.stdout, or to self.stdout
+    when it is a method, is cached with its return value and written again
+    on a cache hit.
+
+    The decorated command gains an invalidate() method, and can be
+    invalidated by other commands using :func:`invalidates`. The built-in
+    ``cache`` command shows hit rates.
+
+    :type ttl: float
+    :param ttl: Time (in seconds) a result stays valid.
+
+    :type maxsize: int
+    :param maxsize: Maximum number of cached results.
+    """
+
+    def inner_cached(func):
+        return CachedCommand(func, ttl, maxsize)
+    return inner_cached
+
+
+def coalesce(func):
+    """Share one execution of the decorated do_*() callable between
+    concurrent calls with the same arguments.
+
+    While a call is running, other threads or sessions calling the command
+    with the same argument string wait for it, and each gets its return
+    value (or a copy of its exception) and has anything it wrote to
+    sys.stdout, or to self.stdout when it is a method, written to its own
+    output. Use it for read-only commands which may be run by
+    many clients at once. The built-in ``cache`` command shows how many
+    calls were saved.
+    """
+
+    return CoalescedCommand(func)
+
+
+def invalidates(*commands):
+    """Invalidate the given @cached commands after the decorated do_*()
+    callable has run successfully."""
+
+    commands = [getattr(cmd, '__func__', cmd) for cmd in commands]
+
+    def inner_invalidates(func):
+        @wraps(func)
+        def invalidating(*args):
+            result = func(*args)
+            for cmd in commands:
+                cmd.invalidate()
+            return result
+        return invalidating
+    return inner_invalidates
+
+
+class _OutputCopy(object):
+    """Context manager which keeps a copy of everything a do_*() callable
+    writes to sys.stdout and, when called as a method, to self.stdout of
+    the shell or session it is bound to.
+
+    :type args: tuple
+    :param args: Arguments the callable is called with.
+    """
+
+    def __init__(self, args):
+        self.obj = args[0] if len(args) > 1 else None
+        self.output = ('', '')
+
+    def __enter__(self):
+        self.sys_tee = Tee(_real_stdout())
+        self.redirect = redirect_stdout(self.sys_tee)
+        self.stdout = getattr(self.obj, 'stdout', None)
+        self.tee = None
+        if self.stdout is not None and self.stdout is not self.sys_tee.stream:
+            self.tee = self.obj.stdout = Tee(self.stdout)
+        self.redirect.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.redirect.__exit__(*exc)
+        if self.tee is not None:
+            self.obj.stdout = self.stdout
+        self.output = (self.sys_tee.copy.getvalue(),
+                       self.tee.copy.getvalue() if self.tee else '')
+        return False
+
+    @staticmethod
+    def write(args, output):
+        """Write output copied from a call again, for a call with args."""
+
+        sys.stdout.write(output[0])
+        if output[1]:
+            args[0].stdout.write(output[1])
+
+
+class CachedCommand(object):
+    """A do_*() callable whose results are cached (see :func:`cached`)."""
+
+    def __init__(self, func, ttl, maxsize):
+        update_wrapper(self, func)
+        self.func = func
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __get__(self, obj, objtype=None):
+        # Bind like a function when used as a method
+        if obj is None:
+            return self
+        return types.MethodType(self, obj)
+
+    def __call__(self, *args):
+        key = args[-1]
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] > now:
+                self.cache.move_to_end(key)
+                self.hits += 1
+            else:
+                entry = None
+                self.misses += 1
+        if entry is not None:
+            _OutputCopy.write(args, entry[2])
+            return entry[1]
+        with _OutputCopy(args) as copy:
+            value = self.func(*args)
+        with self.lock:
+            self.cache[key] = (now + self.ttl, value, copy.output)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return value
+
+    def invalidate(self, args=None):
+        """Discard the cached result for args, or all results."""
+
+        with self.lock:
+            if args is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(args, None)
+
+    def stats(self):
+        """Return a dict of hits, misses and number of cached entries."""
+
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.cache)}
+
+
+class _Flight(object):
+    """A running call of a @coalesce command."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.output = ''
+
+
+class CoalescedCommand(object):
+    """A do_*() callable whose concurrent identical calls share one
+    execution (see :func:`coalesce`)."""
+
+    def __init__(self, func):
+        update_wrapper(self, func)
+        self.func = func
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.saved = 0
+
+    def __get__(self, obj, objtype=None):
+        # Bind like a function when used as a method
+        if obj is None:
+            return self
+        return types.MethodType(self, obj)
+
+    def __call__(self, *args):
+        key = args[-1]
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.saved += 1
+        if not leader:
+            flight.done.wait()
+            _OutputCopy.write(args, flight.output)
+            if flight.error is not None:
+                raise self._copy_error(flight.error) from flight.error
+            return flight.value
+        output = _OutputCopy(args)
+        try:
+            with output:
+                flight.value = self.func(*args)
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            flight.output = output.output
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.value
+
+    @staticmethod
+    def _copy_error(error):
+        """Return a copy of the exception raised by a shared call, for a
+        waiting thread to raise, so that threads don't share (and add to)
+        one exception's traceback."""
+
+        try:
+            return copy.copy(error)
+        except Exception:
+            return RuntimeError("Shared call failed: {0!r}".format(error))
+
+    def stats(self):
+        """Return a dict of calls made, calls saved and calls in flight."""
+
+        return {'calls': self.calls, 'saved': self.saved,
+                'in_flight': len(self.flights)}
+
+
+class Middleware(object):
+    """Base class for code run around every command, such as permission
+    checks, timing or logging, registered with :meth:`Shellac.use`.
+
+    A middleware is called with the next link of the chain, the shell (or
+    :class:`Session`) running the command, the command line, the do_*()
+    callable and its arguments. It runs the rest of the chain (ending with
+    the command itself) by calling ``call(shell, line, func, args)``, and
+    returns the command's result. It can also return without calling the
+    command, or change the arguments first::
+
+        class Timing(shellac.Middleware):
+            def __call__(self, call, shell, line, func, args):
+                start = time.perf_counter()
+                try:
+                    return call(shell, line, func, args)
+                finally:
+                    log.info("%s took %.3fs", line,
+                             time.perf_counter() - start)
+
+    Any callable with the same signature can be used as a middleware; an
+    *applies* method is optional.
+    """
+
+    def applies(self, path, func):
+        """Return False if this middleware has nothing to do for a command,
+        so that it is left out of the command's chain.
+
+        *Can be overridden*.
+
+        :type path: list
+        :param path: The names of the command, e.g. ['user', 'add'].
+
+        :type func: callable
+        :param func: The do_*() callable.
+        """
+
+        return True
+
+    def __call__(self, call, shell, line, func, args):
+        return call(shell, line, func, args)
+
+
+def _call_command(shell, line, func, args):
+    """The last link of every middleware chain."""
+
+    return shell._call(func, args, line)
+
+
+class _NullContext(object):
+    """A context manager which does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
 class Shellac(object):
     """An interactive command interpreter.
     You should never call this class directly. To use it, inherit from this
@@ -69,6 +1095,20 @@ class Shellac(object):
     child methods of classes defined in your subclass to create subcommands
     in the interface.
 
+    Set *command_timeout* to a number of seconds to limit the run time of
+    every command (see :func:`timeout`), and *history_file* to keep a
+    persistent command history (see :mod:`shellac.history`). Set *warmup*
+    to a number of seconds to let cmdloop() spend up to that long warming
+    up completion in the background (see :meth:`warm`). Set *fuzzy* to True
+    for ranked subsequence and abbreviation completion (see
+    :mod:`shellac.fuzzy`); candidates from completion functions are fetched
+    again for it once they are *fuzzy_ttl* seconds old. *completion_limit*
+    is the most completions offered at once (None for no limit); when there
+    are more, :meth:`too_many_matches` is called instead. Set *pager* to True (or a
+    number of lines per screen) to show long output on a terminal a screen
+    at a time (see :mod:`shellac.pager`). Middleware registered with
+    :meth:`use` runs around every command.
+
     :type completekey: *readline* name of a comlpetion key.
     :param completekey: Key to execute completion
 
@@ -93,6 +1133,25 @@ class Shellac(object):
         self.lastcmd = ''
         self.intro = None
         self.cmdqueue = []
+        self.recorder = None
+        self.audit_log = None
+        self.command_timeout = None
+        self.history_file = None
+        self.history = None
+        self.warmup = None
+        self._loaded = time.time()
+        self._mtimes = {}
+        self.aliases = {}
+        self._alias_names = []
+        self.fuzzy = False
+        self.fuzzy_ttl = 5.0
+        self.completion_limit = 1000
+        self.pager = False
+        self._recent = {}
+        self._uses = itertools.count(1)
+        self.middleware = []
+        self._chains = {}
+        self.output_buffers = _BufferPool()
         # raw_input() replaced with input() in python 3
         try:
             self.inp = raw_input
@@ -122,10 +1181,423 @@ class Shellac(object):
 
     do_EOF = do_exit
 
+    def do_history(self, args):
+        """Show the command history.
+
+        history [-n COUNT] [COMMAND...]  show the most recent entries,
+                                         optionally only for a command path
+        history [-n COUNT] /TEXT         show entries containing TEXT
+        """
+
+        if self.history is None:
+            self.stdout.write("*** No history file\n")
+            return
+        self.history.loaded.wait()
+        count = 20
+        tokens = args.split()
+        if len(tokens) > 1 and tokens[0] == '-n' and tokens[1].isdigit():
+            count = int(tokens[1])
+            tokens = tokens[2:]
+        text = ' '.join(tokens)
+        if not text:
+            found = self.history.recent(count)
+        elif text.startswith('/'):
+            found = list(self.history.search(text[1:], limit=count))[::-1]
+        else:
+            found = (entry for entry in self.history.search(text, True)
+                     if entry[1] == text or entry[1].startswith(text + ' '))
+            found = list(itertools.islice(found, count))[::-1]
+        for index, entry in found:
+            self.stdout.write("{0:>6}  {1}\n".format(index + 1, entry))
+
+    def do_watch(self, args):
+        """Run a command repeatedly, redrawing its output, until Ctrl-C.
+
+        watch [-n SECONDS] [-c COUNT] COMMAND...
+        """
+
+        options = self._schedule_options(args, {'-n': 2.0, '-c': None})
+        if options is None or options['-n'] <= 0:
+            self.stdout.write("*** Usage: watch [-n SECONDS] [-c COUNT] "
+                              "COMMAND...\n")
+            return
+        self._schedule(options['line'], options['-n'], options['-c'], True)
+
+    def do_repeat(self, args):
+        """Run a command a number of times.
+
+        repeat COUNT [-n SECONDS] COMMAND...
+        """
+
+        parts = args.split(None, 1)
+        options = None
+        if len(parts) == 2 and parts[0].isdigit():
+            options = self._schedule_options(parts[1], {'-n': 0.0})
+        if options is None:
+            self.stdout.write("*** Usage: repeat COUNT [-n SECONDS] "
+                              "COMMAND...\n")
+            return
+        self._schedule(options['line'], options['-n'], int(parts[0]), False)
+
+    @staticmethod
+    def _schedule_options(args, options):
+        """Parse leading '-n SECONDS' and '-c COUNT' options of watch and
+        repeat. Returns the options (with the command in 'line'), or None
+        if they are invalid."""
+
+        options = dict(options)
+        while True:
+            parts = args.split(None, 2)
+            if not parts or parts[0] not in options:
+                break
+            if len(parts) < 3:
+                return None
+            try:
+                options[parts[0]] = (float(parts[1]) if parts[0] == '-n'
+                                     else int(parts[1]))
+            except ValueError:
+                return None
+            args = parts[2]
+        if not parts:
+            return None
+        options['line'] = args.strip()
+        return options
+
+    def _schedule(self, line, interval, count, redraw):
+        """Run line with onecmd() every interval seconds, count times (or
+        until interrupted if count is None).
+
+        Runs are scheduled at fixed multiples of the interval from the
+        first, so a slow command doesn't push back later runs; runs which
+        would have started while the command was still going are skipped.
+        """
+
+        token = current_token()
+        clear = redraw and getattr(self.stdout, 'isatty', lambda: False)()
+        start = time.monotonic()
+        runs = 0
+        while count is None or runs < count:
+            if cancelled():
+                return
+            if clear:
+                self.stdout.write("\033[H\033[2J")
+            if redraw:
+                self.stdout.write("Every {0}s: {1}    {2}\n\n".format(
+                    interval, line, time.strftime('%Y-%m-%d %H:%M:%S')))
+            self.onecmd(line)
+            self.stdout.flush()
+            runs += 1
+            if count is not None and runs >= count:
+                return
+            if interval:
+                now = time.monotonic()
+                delay = interval - (now - start) % interval
+                if token is not None:
+                    token.event.wait(delay)
+                else:
+                    time.sleep(delay)
+
+    def do_reload(self, args):
+        """Reload the modules which define commands, if they have changed.
+
+        reload             reload modules changed since they were loaded
+        reload MODULE...   reload the named modules
+        """
+
+        modules = self._command_modules(type(self))
+        names = args.split()
+        for name in names:
+            if name not in modules:
+                self.stdout.write("*** Not a command module: {0}\n".format(
+                    name))
+                return
+        if not names:
+            names = [name for name, module in sorted(modules.items())
+                     if self._mtime(module) >
+                     self._mtimes.get(name, self._loaded)]
+        if not names:
+            self.stdout.write("Nothing to reload\n")
+            return
+        for name in names:
+            mtime = self._mtime(modules[name])
+            try:
+                self._reload(modules[name])
+            except Exception as exc:
+                self.stdout.write("*** Reload of {0} failed: {1!r}\n".format(
+                    name, exc))
+                continue
+            self._mtimes[name] = mtime
+            self.stdout.write("Reloaded {0}\n".format(name))
+        self._start_warmup()
+
+    @staticmethod
+    def _mtime(module):
+        try:
+            return os.stat(module.__file__).st_mtime
+        except OSError:
+            return 0
+
+    @classmethod
+    def _command_modules(cls, tree, found=None, seen=None):
+        """Return a dict of the modules (by name) which define the shell
+        class or its do_*() and help_*() members, excluding shellac itself.
+        """
+
+        if found is None:
+            found, seen = {}, set()
+        if tree in seen:
+            return found
+        seen.add(tree)
+        objs = [tree] + [getattr(tree, prefix + name)
+                         for prefix in ('do_', 'help_')
+                         for name in members(tree, prefix)]
+        if inspect.isclass(tree):
+            objs.extend(base for base in tree.__mro__[1:]
+                        if base is not object)
+        for obj in objs:
+            name = getattr(getattr(obj, '__func__', obj), '__module__', None)
+            module = sys.modules.get(name)
+            if name and name != __name__ and \
+                    not name.startswith(__name__ + '.') and \
+                    getattr(module, '__file__', None):
+                found[name] = module
+            if inspect.isclass(obj) and obj is not tree:
+                cls._command_modules(obj, found, seen)
+        return found
+
+    def _reload(self, module):
+        """Re-import a module and rebind the do_*() and help_*() members of
+        this shell's classes which it defines, then forget anything cached
+        for the old members."""
+
+        name = module.__name__
+        module = importlib.reload(module)
+        changed = set()
+        for live in type(self).__mro__:
+            if live is object or live.__module__ == __name__:
+                continue
+            new = _qualname_lookup(module, live.__qualname__) \
+                if live.__module__ == name else None
+            if inspect.isclass(new):
+                # The class itself was redefined: take all its commands
+                for attr in set(vars(live)) | set(vars(new)):
+                    if not attr.startswith(('do_', 'help_')):
+                        continue
+                    if attr in vars(new):
+                        setattr(live, attr, vars(new)[attr])
+                    else:
+                        delattr(live, attr)
+                changed.add(live)
+                continue
+            for attr, value in list(vars(live).items()):
+                func = getattr(value, '__func__', value)
+                qualname = getattr(func, '__qualname__', '<locals>')
+                if not attr.startswith(('do_', 'help_')) or \
+                        getattr(func, '__module__', None) != name or \
+                        '<locals>' in qualname:
+                    # Not from this module, or can't be found again
+                    continue
+                new = _qualname_lookup(module, qualname)
+                if new is None:
+                    delattr(live, attr)
+                elif isinstance(value, staticmethod) and \
+                        not isinstance(new, staticmethod):
+                    setattr(live, attr, staticmethod(new))
+                else:
+                    setattr(live, attr, new)
+                changed.add(live)
+        self._invalidate(name, changed)
+
+    def _invalidate(self, module, classes):
+        """Forget cached state for commands defined in a reloaded module,
+        and for the given classes whose members have changed."""
+
+        for klass in list(_member_names.keys()):
+            if klass.__module__ == module or \
+                    any(base in classes for base in klass.__mro__):
+                _member_names.pop(klass, None)
+        fuzzy.invalidate()
+        for name in members(type(self)):
+            group = getattr(type(self), 'do_' + name)
+            if isinstance(group, Group):
+                for key, child in list(group._children.items()):
+                    if getattr(child, '__module__', None) == module:
+                        del group._children[key]
+
+    def do_cache(self, args):
+        """Show hit rates for cached commands and calls saved by coalesced
+        commands, or 'cache clear' to invalidate the cached commands and
+        fuzzy completion indexes."""
+
+        if args.strip() == 'clear':
+            fuzzy.invalidate()
+        for path, cmd in self._cached_commands(self, []):
+            stats = cmd.stats()
+            if isinstance(cmd, CoalescedCommand):
+                if args.strip() != 'clear':
+                    total = stats['calls'] + stats['saved']
+                    self.stdout.write(
+                        "{0}: {1} calls, {2} saved ({3:.0%}), {4} running\n"
+                        .format(' '.join(path), stats['calls'],
+                                stats['saved'],
+                                stats['saved'] / float(total) if total else 0,
+                                stats['in_flight']))
+                continue
+            if args.strip() == 'clear':
+                cmd.invalidate()
+                continue
+            total = stats['hits'] + stats['misses']
+            self.stdout.write(
+                "{0}: {1} hits, {2} misses ({3:.0%}), {4} entries\n".format(
+                    ' '.join(path), stats['hits'], stats['misses'],
+                    stats['hits'] / float(total) if total else 0,
+                    stats['entries']))
+
+    @classmethod
+    def _cached_commands(cls, tree, path):
+        """Yield (path, command) for every @cached and @coalesce command in
+        the tree."""
+
+        for name in members(tree):
+            child = getattr(tree, 'do_' + name)
+            func = getattr(child, '__func__', child)
+            if isinstance(func, (CachedCommand, CoalescedCommand)):
+                yield path + [name], func
+            elif inspect.isclass(child):
+                for found in cls._cached_commands(child, path + [name]):
+                    yield found
+
+    def do_alias(self, args):
+        """Define or show aliases and macros.
+
+        alias                      show all aliases
+        alias NAME                 show an alias
+        alias NAME COMMAND[; ...]  define an alias, or a macro which runs
+                                   several commands ($1..$9 and $* are
+                                   replaced by the alias's arguments)
+        """
+
+        parts = args.split(None, 1)
+        if len(parts) == 2:
+            try:
+                self.alias(*parts)
+            except ValueError as exc:
+                self.stdout.write("*** {0}\n".format(exc))
+            return
+        names = parts or self._alias_names
+        for name in names:
+            if name not in self.aliases:
+                self.stdout.write("*** No alias {0}\n".format(name))
+                continue
+            self.stdout.write("{0} = {1}\n".format(
+                name, self.aliases[name].expansion))
+
+    def do_unalias(self, args):
+        """Remove aliases.
+
+        unalias NAME...
+        """
+
+        for name in args.split():
+            if not self.unalias(name):
+                self.stdout.write("*** No alias {0}\n".format(name))
+
+    def alias(self, name, expansion):
+        """Define an alias (or a macro, if expansion contains ';').
+
+        The first word of every command line run by onecmd() is looked up
+        in the aliases, so expansion takes the same time however many
+        aliases there are. A line starting with a backslash is never
+        expanded.
+
+        :type name: string
+        :param name: The word to expand.
+
+        :type expansion: string
+        :param expansion: The command line(s) it expands to.
+        """
+
+        if name not in self.aliases:
+            bisect.insort(self._alias_names, name)
+        self.aliases[name] = Alias(name, expansion)
+
+    def unalias(self, name):
+        """Remove an alias. Returns False if there was no such alias."""
+
+        if self.aliases.pop(name, None) is None:
+            return False
+        self._alias_names.remove(name)
+        return True
+
+    def load_aliases(self, path):
+        """Define the aliases in a file.
+
+        Each line holds an alias name followed by its expansion, as for the
+        ``alias`` command. Blank lines and lines starting with '#' are
+        ignored.
+
+        :type path: string
+        :param path: File to read.
+        """
+
+        with open(path) as aliases:
+            for number, line in enumerate(aliases, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = line.split(None, 1)
+                if len(parts) < 2:
+                    raise ValueError("{0}:{1}: no expansion for {2}".format(
+                        path, number, parts[0]))
+                self.alias(*parts)
+
+    def _expand(self, line, seen=frozenset()):
+        """Return the list of command lines an input line expands to.
+
+        As in most shells, an alias is not expanded again inside its own
+        expansion.
+        """
+
+        if line.startswith('\\'):
+            return [line[1:]]
+        parts = line.split(None, 1)
+        alias = self.aliases.get(parts[0]) if parts else None
+        if alias is None or alias.name in seen:
+            return [line]
+        lines = []
+        for command in alias.expand(parts[1] if len(parts) > 1 else ''):
+            lines.extend(self._expand(command, seen | set([alias.name])))
+        return lines
+
+    def _aliases_starting(self, token):
+        """Return the names of the aliases which start with token."""
+
+        names = self._alias_names
+        start = bisect.bisect_left(names, token)
+        return list(itertools.takewhile(lambda name: name.startswith(token),
+                                        names[start:]))
+
+    def _alias_help(self, args):
+        """Return help for an alias, or None if args doesn't name one."""
+
+        parts = args.split(None, 1)
+        if len(parts) != 1 or parts[0] not in self.aliases:
+            return None
+        alias = self.aliases[parts[0]]
+        text = "{0} is an alias for '{1}'".format(alias.name,
+                                                  alias.expansion)
+        if len(alias.commands) == 1 and not alias.parameters:
+            target = self._get_help(alias.commands[0], self.shell
+                                    if isinstance(self, Session) else self)
+            if target:
+                text += "\n\n" + target
+        return text
+
     def do_help(self, args):
         """Help on help"""
 
-        self.stdout.write((self._get_help(args, self) or
+        self.stdout.write((self._alias_help(args) or
+                           self._get_help(args, self) or
                            "*** No help for %s" % (args or repr(self))) + "\n")
 
     @classmethod
@@ -154,6 +1626,27 @@ class Shellac(object):
         else:
             return func(args)
 
+    def use(self, middleware):
+        """Register a middleware to run around every command (see
+        :class:`Middleware`).
+
+        Middleware runs in the order it was registered, the first outermost,
+        and is shared by all sessions of the shell. Unlike overriding
+        precmd() and postcmd(), each middleware is independent of the
+        others, and is only called for the commands it applies to. Lines
+        merged into a batch for a @batchable command's bulk handler don't
+        pass through middleware.
+
+        :param middleware: A Middleware, or a callable with the same
+                           signature.
+
+        :return: middleware
+        """
+
+        self.middleware.append(middleware)
+        self._chains.clear()
+        return middleware
+
     def precmd(self, line):
         """Hook method executed just before the command line is dispatched.
 
@@ -209,6 +1702,8 @@ class Shellac(object):
         This method will also:
 
         * Execute a preloop() method before starting the interpreter
+        * Start loading the history_file, if set, in the background
+        * Start warming up completion, if warmup is set, in the background
         * Install a complete() readline completer function
         * Write the string intro followed by a newline to stdout
             * Read from a list of commands called cmdqueue, or
@@ -220,6 +1715,8 @@ class Shellac(object):
         """
 
         self.preloop()
+        self._load_history()
+        self._start_warmup()
         old_completer = readline.get_completer()
         readline.set_completer(self.complete)
         readline.parse_and_bind(self.completekey + ": complete")
@@ -228,37 +1725,344 @@ class Shellac(object):
             if self.intro:
                 self.stdout.write(str(self.intro) + "\n")
             stop = None
+            readline_history = False
             while not stop:
-                if self.cmdqueue:
-                    line = self.cmdqueue.pop()
-                else:
+                try:
+                    if self.cmdqueue:
+                        stop = self._runlines(self._next_queued)
+                        continue
+                    if not readline_history and self.history is not None \
+                            and self.history.loaded.is_set():
+                        for _, entry in self.history.recent(1000):
+                            readline.add_history(entry)
+                        readline_history = True
                     try:
                         line = self.inp(self.prompt)
                     except EOFError:
                         self.stdout.write("\n")
                         line = 'EOF'
-                    except KeyboardInterrupt as exc:
-                        self.ctrl_c(exc)
-                        self.cancel()
-                        continue
-                try:
-                    line = self.precmd(line)
-                    stop = self.onecmd(line)
-                    stop = self.postcmd(stop, line)
+                    else:
+                        if self.history is not None:
+                            self.history.append(line)
+                    stop = self._runline(line)
                 except KeyboardInterrupt as exc:
+                    self._flush_logs()
                     self.ctrl_c(exc)
                     self.cancel()
             self.postloop()
         finally:
+            self._flush_logs()
             readline.set_completer(old_completer)
 
+    def _load_history(self):
+        """Start loading the history file in the background, if there is one
+        and it hasn't been loaded yet."""
+
+        if self.history is None and self.history_file:
+            self.history = History(self.history_file)
+            self.history.load_async()
+
+    def _start_warmup(self):
+        """Start warming up completion in the background, if warmup is set."""
+
+        def warm():
+            try:
+                self.warm(self.warmup)
+            except Exception:
+                # Completion will report the error when it is used
+                pass
+
+        if self.warmup:
+            thread = threading.Thread(target=warm, name="shellac warmup")
+            thread.daemon = True
+            thread.start()
+
+    def warm(self, budget=None):
+        """Prepare for completion ahead of the first Tab press.
+
+        The names of the top-level and second-level commands are looked up
+        (and cached), and completion functions marked with :func:`warmable`
+        are called with an empty token and their results consumed. Groups
+        are not expanded, since their children may be costly to create.
+        Completion functions run as for :meth:`complete_line`, so warming
+        doesn't change readline's state.
+
+        :type budget: float
+        :param budget: Maximum time to spend (in seconds), or None.
+
+        :return: True if warming finished within the budget
+        """
+
+        deadline = None if budget is None else time.monotonic() + budget
+        detached = _detached.set(True)
+        try:
+            level = [(self, list(members(self)))]
+            for depth in range(2):
+                below = []
+                for tree, names in level:
+                    for name in names:
+                        if deadline is not None and \
+                                time.monotonic() > deadline:
+                            return False
+                        try:
+                            child = getattr(tree, 'do_' + name)
+                        except AttributeError:
+                            continue
+                        for func in getattr(child, 'completions', ()):
+                            if getattr(getattr(func, '__func__', func),
+                                       'warmable', False):
+                                if not self._consume(func, deadline):
+                                    return False
+                        if inspect.isclass(child) and depth == 0:
+                            below.append((child, list(members(child))))
+                level = below
+            return True
+        finally:
+            _detached.reset(detached)
+
+    def _consume(self, func, deadline):
+        """Call a completion function with an empty token and read all of
+        its results, giving up at the deadline."""
+
+        for i, _ in enumerate(self.call_static(func, '')):
+            if deadline is not None and not i % 1000 and \
+                    time.monotonic() > deadline:
+                return False
+        return True
+
+    def runscript(self, lines):
+        """Run a script of command lines without using readline.
+
+        Each line is passed through precmd(), onecmd() and postcmd() as in
+        cmdloop(), between calls to preloop() and postloop(). Consecutive
+        lines which call the same @batchable command are merged into a
+        single call of its bulk handler.
+
+        :type lines: iterable
+        :param lines: Command lines, e.g. a list or an open file.
+
+        :return: The stop flag returned by the last command.
+        """
+
+        self.preloop()
+        try:
+            if isinstance(lines, (list, tuple)):
+                lines = iter(line.rstrip('\r\n') for line in lines)
+                next_line = lambda timeout: next(lines, None)
+            else:
+                next_line = _reader(lines)
+            stop = self._runlines(next_line)
+            self.postloop()
+        finally:
+            self._flush_logs()
+        return stop
+
+    def _next_queued(self, timeout=None):
+        """Return the next line from cmdqueue, or None if it is empty."""
+
+        return self.cmdqueue.pop() if self.cmdqueue else None
+
+    def _runline(self, line):
+        """Run a line through precmd(), onecmd() and postcmd(), recording
+        it if required, and return the stop flag."""
+
+        if self.recorder is not None:
+            self.recorder.line(line)
+        with self._capture(line):
+            line = self.precmd(line)
+            stop = self.onecmd(line)
+            return self.postcmd(stop, line)
+
+    def _runlines(self, next_line):
+        """Run lines until there are none left or a command returns a stop
+        flag, merging consecutive lines for the same @batchable command.
+
+        :type next_line: callable
+        :param next_line: Called with a timeout (or None) to get the next
+                          line. Returns None when there are no more lines,
+                          or raises queue.Empty if none arrived in time.
+        """
+
+        stop = None
+        batch = []
+        spec = None
+        deadline = None
+        found = None
+        while not stop:
+            timeout = None
+            if batch:
+                timeout = max(0, deadline - time.monotonic())
+            try:
+                line = next_line(timeout)
+            except queue.Empty:
+                stop = self._run_batch(spec, batch)
+                continue
+            if line is None:
+                break
+            found = self._resolve_next(line, found)
+            line_spec = self._batch_spec(found)
+            if batch and line_spec is not spec:
+                stop = self._run_batch(spec, batch)
+                if stop:
+                    break
+            if line_spec is None:
+                stop = self._runline(line)
+                continue
+            if self.recorder is not None:
+                self.recorder.line(line)
+            checked = self.precmd(line)
+            if checked != line:
+                found = self._resolve_next(checked, found)
+                if self._batch_spec(found) is not line_spec:
+                    # precmd() changed the command: run it after the lines
+                    # before it, like any other line
+                    if batch:
+                        stop = self._run_batch(spec, batch)
+                        if stop:
+                            break
+                    with self._capture(line):
+                        stop = self.postcmd(self.onecmd(checked), checked)
+                    continue
+                line = checked
+            if not batch:
+                spec = line_spec
+                deadline = time.monotonic() + spec.max_delay
+            batch.append((line, found))
+            if len(batch) >= spec.max_batch:
+                stop = self._run_batch(spec, batch)
+        if batch and not stop:
+            stop = self._run_batch(spec, batch)
+        return stop
+
+    def _resolve_next(self, line, known):
+        """Resolve a command line as _resolve() does, reusing known (the
+        result for an earlier line) if line starts with the same command
+        words, so that a run of lines calling one command is only looked
+        up once."""
+
+        if known is not None:
+            path = known[0]
+            words = line.split(None, len(path))
+            if words[:len(path)] == path:
+                return (path, known[1],
+                        words[len(path)] if len(words) > len(path) else '')
+        return self._resolve(line) if line else None
+
+    def _batch_spec(self, found):
+        """Return the Batch for a resolved command line, if its command is
+        @batchable.
+
+        Lines are not batched if they would be expanded as an alias, or if
+        middleware applies to the command, so that middleware sees every
+        line.
+        """
+
+        spec = getattr(found[1], 'batch', None) if found else None
+        if spec is None or found[0][0] in self.aliases or \
+                self._chain(found[0], found[1]) is not _call_command:
+            return None
+        return spec
+
+    def _run_batch(self, spec, batch):
+        """Pass a batch of (line, resolved command) to its bulk handler, then
+        call postcmd() with the result for each line.
+
+        The handler runs with the command's timeout, and its output is
+        recorded against the last line of the batch.
+        """
+
+        lines = [line for line, _ in batch]
+        args = [found[2] for _, found in batch]
+        command = batch[0][1][1]
+        del batch[:]
+        start = time.time()
+        began = time.perf_counter()
+        with self._capture(lines[-1]):
+            results = self._call(spec.handler, args, lines[-1], command)
+        duration = (time.perf_counter() - began) / len(lines)
+        if results is None or isinstance(results, bool):
+            # No results, or the stop flag from timed_out()
+            results = [results] * len(lines)
+        else:
+            results = list(results)
+            if len(results) != len(lines):
+                raise ValueError(
+                    "bulk handler {0} returned {1} results for {2} lines"
+                    .format(getattr(spec.handler, '__name__', spec.handler),
+                            len(results), len(lines)))
+        stop = None
+        for line, result in zip(lines, results):
+            self.lastcmd = line
+            if self.audit_log is not None:
+                self.audit_log.log(line, start, duration, result)
+            stop = self.postcmd(result, line) or stop
+        return stop
+
+    def _resolve(self, args, root=None):
+        """Find the do_*() callable for a command line.
+
+        :type args: string
+        :param args: command line
+
+        :type root: object
+        :param root: class or object to start from (defaults to self)
+
+        :return: a (path, callable, remaining args) tuple, or None
+        """
+
+        if root is None:
+            root = self
+        path = []
+        while True:
+            parts = args.split(None, 1)
+            child = parts[0] if parts else args
+            args = parts[1] if len(parts) > 1 else ''
+            try:
+                root = getattr(root, 'do_' + child)
+            except AttributeError:
+                return None
+            path.append(child)
+            if inspect.isclass(root):
+                # If a class, we must instantiate it
+                root = root()
+            if callable(root):
+                return path, root, args
+            if not args:
+                return None
+
+    def _chain(self, path, func):
+        """Return the middleware chain for a do_*() callable, compiling it
+        the first time the command is run.
+
+        Middleware whose applies() returns False for the command is left
+        out, so it costs nothing. Chains are kept per command path and
+        rebuilt if the command's function changes (e.g. when reloaded).
+        """
+
+        target = getattr(func, '__func__', func)
+        if not isinstance(target, types.FunctionType):
+            # Callable instances are created afresh for every call
+            target = type(target)
+        key = tuple(path)
+        compiled = self._chains.get(key)
+        if compiled is not None and compiled[0] is target:
+            return compiled[1]
+        chain = _call_command
+        for middleware in reversed(self.middleware):
+            applies = getattr(middleware, 'applies', None)
+            if applies is None or applies(path, func):
+                chain = partial(middleware, chain)
+        self._chains[key] = (target, chain)
+        return chain
+
     def onecmd(self, line, args='', root=None):
         """Execute a single command line.
 
         If the given line is False (i.e. empty), call return the result of
         emptyline(). Thereafter, try to find a chain of do_*() methods and
         classes which ends with a callable, then return the result of calling
-        it.
+        it. If the callable returns a generator, its items are written to
+        stdout as lines (through the pager, if enabled) as they are produced.
 
         :type line: string
         :param line: line to be executed
@@ -270,37 +2074,173 @@ class Shellac(object):
         :param root: 'current' 'do_' class or method during recursion
         """
 
+        if root is None and line and (self.aliases or line[0] == '\\'):
+            lines = self._expand(line)
+            if len(lines) > 1:
+                return self._run_macro(lines)
+            line = lines[0]
+        if root is None and self.audit_log is not None and line:
+            return self._audited(line)
         if not args:
             args = line
-        if not root:
-            root = self
-        if args:
-            try:
-                child, args = args.split(None, 1)
-            except ValueError:
-                child = args
-                args = ''
-        elif not line:
+        if not args:
             return self.emptyline()
         self.lastcmd = line
         if line == 'EOF':  # http://bugs.python.org/issue13500
             self.lastcmd = ''
-        try:
-            root = getattr(root, 'do_' + child)
-        except AttributeError:
+        found = self._resolve(args, root)
+        if found is None:
             return self.default(line)
-        if inspect.isclass(root):
-            # If a class, we must instantiate it
-            root = root()
+        if self.fuzzy and (root is None or root is self):
+            # A command group counts as used when any command in it is
+            used = next(self._uses)
+            for depth in range(1, len(found[0]) + 1):
+                self._recent[' '.join(found[0][:depth])] = used
+        call = self._chain(found[0], found[1])
         try:
-            # Is root (really) callable
-            return root(args)
-        # python2 and 3 return different exceptions here
-        except (AttributeError, TypeError):
-            # It wasn't callable, recurse
-            if not args:
-                return self.default(line)
-            return self.onecmd(line, args, root)
+            if self.pager and not isinstance(self.stdout, Pager) and \
+                    self.stdout.isatty():
+                return self._paged(call, found[1], found[2], line)
+            return self._write_lines(call(self, line, found[1], found[2]),
+                                     self.stdout)
+        except ArgumentError as exc:
+            if exc.command is None:
+                exc.command = ' '.join(found[0])
+            return self.argument_error(line, exc)
+
+    def _run_macro(self, lines):
+        """Run the command lines of a macro in order, stopping at the first
+        which returns a stop flag, and return its stop flag."""
+
+        stop = None
+        for line in lines:
+            # The lines are already expanded
+            stop = self.onecmd('\\' + line)
+            if stop:
+                break
+        return stop
+
+    @staticmethod
+    def _write_lines(result, stream):
+        """If a command returned a generator, write its items to stream as
+        lines and return None, otherwise return the result."""
+
+        if not inspect.isgenerator(result):
+            return result
+        for item in result:
+            stream.write("{0}\n".format(item))
+        return None
+
+    def _paged(self, call, func, args, line):
+        """Call a do_*() callable through its middleware chain, with its
+        output going through a Pager."""
+
+        pager = Pager(self.stdout, self.stdin,
+                      None if self.pager is True else self.pager)
+        stdout = self.stdout
+        self.stdout = pager
+        result = None
+        try:
+            with redirect_stdout(pager):
+                result = call(self, line, func, args)
+                result = self._write_lines(result, pager)
+                pager.close()
+        except PagerQuit:
+            if inspect.isgenerator(result):
+                # Stop the producer
+                result.close()
+            return None
+        finally:
+            self.stdout = stdout
+        return result
+
+    def argument_error(self, line, exc):
+        """Method called when a command line doesn't match the command's
+        declared arguments (see :func:`arguments`).
+
+        *Can be overridden*.
+
+        :type line: string
+        :param line: The command line.
+
+        :type exc: ArgumentError
+        :param exc: The error, with the argument at fault and the usage.
+        """
+
+        self.stdout.write("*** {0}\n".format(exc.message))
+        if exc.usage is not None:
+            self.stdout.write("Usage: {0} {1}\n".format(exc.command,
+                                                         exc.usage))
+
+    def _call(self, func, args, line, command=None):
+        """Call a do_*() callable, on a worker thread if it has a timeout.
+
+        :type command: callable
+        :param command: The do_*() callable whose timeout applies, if func
+                        is a bulk handler running on its behalf.
+        """
+
+        seconds = getattr(command or func, 'timeout', self.command_timeout)
+        if not seconds:
+            return func(args)
+        token = CancelToken()
+        done = threading.Event()
+        result = {}
+
+        def worker():
+            _current_token.set(token)
+            try:
+                result['value'] = func(args)
+            except BaseException as exc:
+                result['error'] = exc
+            finally:
+                done.set()
+
+        thread = threading.Thread(target=contextvars.copy_context().run,
+                                  args=(worker,), name="shellac: " + line)
+        thread.daemon = True
+        thread.start()
+        try:
+            finished = done.wait(seconds)
+        except KeyboardInterrupt:
+            token.cancel()
+            raise
+        if not finished:
+            token.cancel()
+            abandoned = _abandoned.get()
+            if abandoned is not None:
+                abandoned.append(thread)
+            return self.timed_out(line, seconds)
+        if 'error' in result:
+            raise result['error']
+        return result.get('value')
+
+    def timed_out(self, line, seconds):
+        """Method called when a command runs for longer than its timeout.
+
+        The command is left to finish in the background, with its
+        CancelToken cancelled. The return value is used as the command's
+        stop flag.
+
+        *Can be overridden*.
+        """
+
+        self.stdout.write("*** Timed out after {0}s: {1}\n".format(seconds,
+                                                                  line))
+
+    def _audited(self, line):
+        """Execute line with onecmd() and log it to the audit log."""
+
+        start = time.time()
+        began = time.perf_counter()
+        try:
+            stop = self.onecmd(line, root=self)
+        except BaseException as exc:
+            self.audit_log.log(line, start, time.perf_counter() - began,
+                               error=exc)
+            raise
+        self.audit_log.log(line, start, time.perf_counter() - began, stop)
+        return stop
 
     # traverse_help is recursive so needs to find itself through the class
     @classmethod
@@ -320,8 +2260,9 @@ class Shellac(object):
         elif len(tokens) == 0:
             return members(tree)
         if len(tokens) == 1:
-            return complete_list(set(members(tree, 'help_')) | set(members(tree)), tokens[0])
-        elif tokens[0] in members(tree):
+            return complete_list(set(members(tree, 'help_', tokens[0])) |
+                                 set(members(tree, start=tokens[0])), tokens[0])
+        elif hasattr(tree, 'do_' + tokens[0]):
             return cls._traverse_help(tokens[1:],
                                       getattr(tree, 'do_' + tokens[0]))
         return []
@@ -364,15 +2305,17 @@ class Shellac(object):
             return []
         elif len(tokens) == 0:
             return members(tree)
+        if hasattr(tree, 'schema') and not hasattr(tree, 'completions'):
+            return tree.schema.complete(tokens)
         if len(tokens) == 1:
             if hasattr(tree, 'completions'):
-                return (c for f in tree.completions for c in cls.call_static(f, tokens[0]))
-            return complete_list(members(tree), tokens[0])
-        if tokens[0] in members(tree):
+                return _merge_completions(tree.completions, tokens[0])
+            return complete_list(members(tree, start=tokens[0]), tokens[0])
+        if hasattr(tree, 'do_' + tokens[0]):
             return cls._traverse_do(tokens[1:],
                                     getattr(tree, 'do_' + tokens[0]))
         if hasattr(tree, 'completions'):
-            return (c for f in tree.completions for c in cls.call_static(f, tokens[-1]))
+            return _merge_completions(tree.completions, tokens[-1])
         return []
 
     @rl.generator
@@ -390,13 +2333,372 @@ class Shellac(object):
 
         endidx = readline.get_endidx()
         buf = readline.get_line_buffer()
+        matches = self._complete(buf, endidx)
+        if self.recorder is not None:
+            matches = list(matches)
+            self.recorder.completion(buf, endidx, matches)
+        return matches
+
+    def _complete(self, buf, endidx):
+        """Return possible completions for the given line buffer, as for
+        complete().
+
+        :type buf: string
+        :param buf: line buffer
+
+        :type endidx: int
+        :param endidx: index of the cursor in the line buffer
+        """
+
+        matches = self._complete_line(buf, endidx)
+        limit = self.completion_limit
+        if limit is None:
+            return matches
+        matches = list(itertools.islice(matches, limit + 1))
+        if len(matches) > limit:
+            return self.too_many_matches(limit)
+        return matches
+
+    def too_many_matches(self, limit):
+        """Method called when there are more than completion_limit
+        completions. The candidates are not read past the limit.
+
+        *Can be overridden*.
+
+        :type limit: int
+        :param limit: The completion_limit.
+
+        :return: The completions to offer instead (none by default).
+        """
+
+        self.stdout.write("\n*** too many matches ({0}+)\n".format(limit))
+        if readline.get_line_buffer():
+            readline.redisplay(True)
+        return []
+
+    def complete_line(self, line, cursor=None):
+        """Return the completions offered when Tab is pressed at cursor in
+        line, without using readline, e.g. to serve completion to a web
+        console or an editor.
+
+        At most completion_limit completions are returned; too_many_matches()
+        is not called, and the session isn't recorded.
+
+        :type line: string
+        :param line: The command line.
+
+        :type cursor: int
+        :param cursor: Index of the cursor in line (defaults to the end).
+
+        :return: list
+        """
+
+        return self.complete_lines([(line, cursor)])[0]
+
+    def complete_lines(self, lines):
+        """Return the completions for many lines at once, as for
+        complete_line().
+
+        The walk down the command tree is shared between lines with the
+        same leading command words, and lines which are the same up to the
+        cursor are only completed once. Command groups which are classes
+        are instantiated once per call and the instance is shared by every
+        line below it, so their completers shouldn't keep state between
+        lines.
+
+        :type lines: iterable
+        :param lines: Lines, or (line, cursor) tuples or lists.
+
+        :return: list of lists, in the order of lines
+        """
+
+        limit = self.completion_limit
+        memo = {}
+        done = {}
+        results = []
+        detached = _detached.set(True)
+        try:
+            for item in lines:
+                if isinstance(item, (tuple, list)):
+                    line, cursor = item
+                else:
+                    line, cursor = item, None
+                if cursor is None:
+                    cursor = len(line)
+                key = line[:cursor]
+                if key not in done:
+                    matches = self._complete_line(line, cursor, memo)
+                    done[key] = list(itertools.islice(matches, limit))
+                results.append(list(done[key]))
+        finally:
+            _detached.reset(detached)
+        return results
+
+    def _complete_line(self, buf, endidx, memo=None):
+        """Return an iterable of completions for the line buffer, without
+        any limit.
+
+        :type memo: dict
+        :param memo: Shared between calls to reuse tree traversal (see
+                     _descend()).
+        """
+
         tokens = buf[:endidx].split()
         if not tokens or buf[endidx - 1] == ' ':
             tokens.append('')
+        if self.aliases:
+            if len(tokens) == 1 or (len(tokens) == 2 and tokens[0] == "help"):
+                aliases = self._aliases_starting(tokens[-1])
+                if aliases:
+                    return sorted(set(aliases) | set(self._complete_tokens(
+                        tokens, memo)))
+            elif tokens[0] in self.aliases:
+                alias = self.aliases[tokens[0]]
+                if len(alias.commands) == 1 and not alias.parameters:
+                    tokens = alias.commands[0].split() + tokens[1:]
+        return self._complete_tokens(tokens, memo)
+
+    def _complete_tokens(self, tokens, memo=None):
+        """Return possible completions for the last of the given tokens."""
+
+        if self.fuzzy and tokens[-1] and tokens[0] != "help":
+            matches = self._fuzzy_complete(tokens)
+            if matches is not None:
+                return matches
         if tokens[0] == "help":
             return self._traverse_help(tokens[1:], self)
         else:
-            return self._traverse_do(tokens, self)
+            tree, tokens = self._descend(tokens, memo)
+            return self._traverse_do(tokens, tree)
+
+    def _descend(self, tokens, memo=None):
+        """Follow the command words in tokens (all but the last) down the
+        tree of do_*() members as far as _traverse_do() would before
+        completing, and return (tree, remaining tokens).
+
+        :type memo: dict
+        :param memo: Where the tree reached for each prefix of tokens is
+                     kept, so that lines with the same leading words can
+                     carry on from where an earlier line got to (sharing
+                     any command group instances created on the way).
+        """
+
+        tree, used, stopped = self, 0, False
+        if memo is not None:
+            for end in range(len(tokens) - 1, 0, -1):
+                found = memo.get(tuple(tokens[:end]))
+                if found is not None:
+                    tree, used, stopped = found
+                    break
+        while not stopped and used < len(tokens) - 1:
+            name = 'do_' + tokens[used]
+            if tree is None or not hasattr(tree, name) or \
+                    (hasattr(tree, 'schema') and
+                     not hasattr(tree, 'completions')):
+                # Any further words are completed from here
+                stopped = True
+            else:
+                tree = getattr(tree, name)
+                if inspect.isclass(tree):
+                    tree = tree()
+                used += 1
+            if memo is not None:
+                memo[tuple(tokens[:used + stopped])] = (tree, used, stopped)
+        return tree, tokens[used:]
+
+    def _fuzzy_complete(self, tokens):
+        """Return ranked fuzzy completions for the last of the given tokens,
+        or None if fuzzy matching doesn't apply there (e.g. in the
+        arguments of a command without a completion function)."""
+
+        tree = self
+        path = []
+        for i, token in enumerate(tokens[:-1]):
+            try:
+                tree = getattr(tree, 'do_' + token)
+            except AttributeError:
+                return None
+            path.append(token)
+            if inspect.isclass(tree):
+                tree = tree()
+            if callable(tree):
+                if i == len(tokens) - 2 and hasattr(tree, 'completions') \
+                        and not hasattr(tree, 'schema'):
+                    return self._fuzzy_candidates(tree.completions,
+                                                  tokens[-1])
+                return None
+        if isinstance(tree, Group):
+            return None
+        query = tokens[-1]
+        prefix = ' '.join(path + [''])
+        recency = lambda name: self._recent.get(prefix + name, 0)
+        # Sessions are keyed on their shell's class, not on Session
+        key = type(tree.shell) if isinstance(tree, Session) else type(tree)
+        found = fuzzy.index(key, lambda: members(tree)).scored(query,
+                                                                recency)
+        for name in set(' '.join(words)
+                        for words in self._abbreviations(tree, query)):
+            found.append((fuzzy.score(query, name, used=recency(name)),
+                          name))
+        found.sort()
+        return [name for _, name in found]
+
+    def _fuzzy_candidates(self, completions, token):
+        """Fuzzy-match token against everything the completion functions
+        return for an empty token (indexed for up to fuzzy_ttl seconds).
+
+        Returns None if nothing matches, so that completion falls back to
+        calling the completion functions with the token, which sees
+        candidates added since the index was built.
+        """
+
+        found = []
+        for func in completions:
+            key = getattr(func, '__func__', func)
+            names = lambda: self.call_static(func, '')
+            found.extend(fuzzy.index(key, names, self.fuzzy_ttl).scored(
+                token))
+        if not found:
+            return None
+        found.sort()
+        return [name for _, name in found]
+
+    @classmethod
+    def _abbreviations(cls, tree, query, depth=4):
+        """Yield lists of command words across two or more levels of the
+        tree whose leading characters spell out query, e.g. ['group',
+        'member', 'add'] for 'gma'."""
+
+        if isinstance(tree, Group) or depth == 0:
+            return
+        for name in members(tree, start=query[0]):
+            child = getattr(tree, 'do_' + name)
+            if not inspect.isclass(child) or isinstance(child, Group):
+                continue
+            for used in range(1, len(query)):
+                if not name.startswith(query[:used]):
+                    break
+                for words in cls._abbreviations_from(child, query[used:],
+                                                     depth - 1):
+                    yield [name] + words
+
+    @classmethod
+    def _abbreviations_from(cls, tree, query, depth):
+        """As _abbreviations(), but a single level may complete query."""
+
+        for name in members(tree, start=query[0]):
+            if name.startswith(query):
+                yield [name]
+        for words in cls._abbreviations(tree, query, depth):
+            yield words
+
+    def record(self, path):
+        """Record this session to an append-only file.
+
+        Input lines, completion requests and command output are appended
+        to the file, which can be replayed with :func:`shellac.record.replay`.
+
+        Any earlier recording is closed. The :class:`shellac.record.Recorder`
+        is returned, and can be used in a with statement to stop recording.
+
+        :type path: string
+        :param path: File to record to.
+
+        :return: shellac.record.Recorder
+        """
+
+        if self.recorder is not None:
+            self.recorder.close()
+        self.recorder = Recorder(path)
+        return self.recorder
+
+    def execute(self, line):
+        """Run a command line and return its outcome and output, e.g. to run
+        commands on behalf of a service.
+
+        The line is run through precmd(), onecmd() and postcmd() in a new
+        :class:`Session`, with its output, including print(), captured in
+        a buffer from the shell's *output_buffers* pool. Output is
+        redirected only for the calling thread, so many threads can
+        execute commands through the same shell at once.
+
+        :type line: string
+        :param line: The command line.
+
+        :return: Result(stop, output, error, duration), where error is the
+                 exception raised by the command, if any
+        """
+
+        shell = self.shell if isinstance(self, Session) else self
+        pool = shell.output_buffers
+        buffer = pool.get()
+        session = Session(shell, stdout=buffer, prompt='')
+        stop = error = None
+        abandoned = []
+        reset = _abandoned.set(abandoned)
+        began = time.perf_counter()
+        try:
+            with redirect_stdout(buffer):
+                try:
+                    line = session.precmd(line)
+                    stop = session.onecmd(line)
+                    stop = session.postcmd(stop, line)
+                except Exception as exc:
+                    error = exc
+            duration = time.perf_counter() - began
+            return Result(stop, buffer.getvalue(), error, duration)
+        finally:
+            _abandoned.reset(reset)
+            if not any(thread.is_alive() for thread in abandoned):
+                pool.put(buffer)
+
+    def serve(self, address):
+        """Serve this shell to many clients at once over a socket.
+
+        Each connection gets its own :class:`Session`, and the output of its
+        commands (including print()) is sent back over the connection. See
+        :mod:`shellac.server` for the protocol. Blocks until interrupted.
+
+        :type address: string, int or tuple
+        :param address: A UNIX domain socket path, a TCP port on localhost,
+                        or a (host, port) tuple.
+        """
+
+        from shellac import server
+        srv = server.make_server(self, address)
+        try:
+            srv.serve_forever()
+        finally:
+            srv.server_close()
+
+    def audit(self, path, **options):
+        """Log every command executed by onecmd() to an audit log.
+
+        Records are queued in memory and written in batches by a background
+        thread (see :class:`shellac.audit.AuditLog` for the options). The log
+        is flushed when cmdloop() finishes or is interrupted.
+
+        :type path: string
+        :param path: File to append audit records to.
+        """
+
+        self.audit_log = AuditLog(path, **options)
+
+    def _flush_logs(self):
+        """Wait for queued audit records and history to be written."""
+
+        if self.audit_log is not None:
+            self.audit_log.flush()
+        if self.history is not None:
+            self.history.flush()
+
+    def _capture(self, line):
+        """Return a context manager which records the output of line, if
+        this session is being recorded."""
+
+        if self.recorder is None:
+            return _NullContext()
+        return self.recorder.capture(self, line)
 
     def cancel(self, prompt=False):
         """Update the shell to indicate a 'cancel'.
@@ -409,3 +2711,129 @@ class Shellac(object):
         readline.replace_line("")
         if prompt:
             readline.redisplay(True)
+
+
+class Session(object):
+    """Per-session state for a shell whose command tree is shared.
+
+    A Session holds only the state which belongs to a single user of a shell
+    (its prompt, last command, command queue and streams). Everything else -
+    the do_*() tree, help_*() methods, hooks and settings such as the audit
+    log - is looked up on the shared Shellac instance. Methods of the shell
+    class are run with the session as *self*, so onecmd(), default(),
+    precmd() and friends read and write per-session state.
+
+    Sessions never touch readline, so many of them can run in one process,
+    for example one per network connection.
+
+    Note that methods of the shell class which call super() cannot be run
+    with a session as *self*.
+
+    :type shell: Shellac
+    :param shell: The shared shell instance.
+
+    :type stdin: File-like object
+    :param stdin: Override stdin (defaults to *shell.stdin*)
+
+    :type stdout: File-like object
+    :param stdout: Override stdout (defaults to *shell.stdout*)
+
+    :type prompt: string
+    :param prompt: Override the prompt (defaults to *shell.prompt*)
+    """
+
+    __slots__ = ('shell', 'stdin', 'stdout', 'prompt', 'lastcmd', 'cmdqueue')
+
+    def __init__(self, shell, stdin=None, stdout=None, prompt=None):
+        self.shell = shell
+        self.stdin = shell.stdin if stdin is None else stdin
+        self.stdout = shell.stdout if stdout is None else stdout
+        self.prompt = shell.prompt if prompt is None else prompt
+        self.lastcmd = ''
+        self.cmdqueue = []
+
+    def __getattr__(self, name):
+        """Look up anything which isn't per-session state on the shell.
+
+        Members of the shell's class which bind to an instance (functions,
+        and wrappers such as @cached commands) are bound to the session,
+        everything else is taken from the shell instance.
+        """
+
+        if name == 'shell':
+            raise AttributeError(name)
+        shell = self.shell
+        if name not in vars(shell):
+            for klass in type(shell).__mro__:
+                if name in vars(klass):
+                    attr = vars(klass)[name]
+                    if hasattr(attr, '__get__') and not inspect.isclass(attr):
+                        return attr.__get__(self, type(shell))
+                    break
+        return getattr(shell, name)
+
+    def __dir__(self):
+        return sorted(set(dir(self.shell)) | set(self.__slots__))
+
+    def __repr__(self):
+        return "<%s of %r>" % (self.__class__.__name__, self.shell)
+
+    def do_help(self, args):
+        """Help on help"""
+
+        self.stdout.write((self._alias_help(args) or
+                           self.shell._get_help(args, self.shell) or
+                           "*** No help for %s" % (args or repr(self.shell)))
+                          + "\n")
+
+    def too_many_matches(self, limit):
+        """Method called when there are more than completion_limit
+        completions (see :meth:`Shellac.too_many_matches`)."""
+
+        self.stdout.write("*** too many matches ({0}+)\n".format(limit))
+        return []
+
+    def cmdloop(self):
+        """Run an interactive command interpreter for this session.
+
+        This behaves like :meth:`Shellac.cmdloop`, but reads lines from
+        *stdin* without using readline.
+        """
+
+        self.preloop()
+        try:
+            if self.intro:
+                self.stdout.write(str(self.intro) + "\n")
+            stop = None
+            while not stop:
+                try:
+                    if self.cmdqueue:
+                        stop = self._runlines(self._next_queued)
+                        continue
+                    if self.prompt:
+                        self.stdout.write(self.prompt)
+                        self.stdout.flush()
+                    line = self.stdin.readline()
+                    if line:
+                        line = line.rstrip('\r\n')
+                    else:
+                        line = 'EOF'
+                    stop = self._runline(line)
+                except KeyboardInterrupt as exc:
+                    self._flush_logs()
+                    self.ctrl_c(exc)
+                    self.cancel()
+            self.postloop()
+        finally:
+            self._flush_logs()
+
+    def cancel(self, prompt=False):
+        """Update the session to indicate a 'cancel'.
+
+        :type prompt: boolean
+        :param prompt: If True, redraw the prompt.
+        """
+
+        self.stdout.write(" ^C\n")
+        if prompt:
+            self.stdout.write(self.prompt)
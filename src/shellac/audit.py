@@ -0,0 +1,67 @@
+#!/usr/bin/python
+"""
+Audit log
+=========
+
+Log every executed command line, with its user, start time, duration and
+result, without adding disk latency to the command itself.
+
+Records are written as one JSON object per line by a background
+:class:`shellac.writer.AsyncWriter`. Auditing is enabled with
+:meth:`shellac.Shellac.audit`.
+"""
+
+import getpass
+import json
+import time
+
+from shellac.writer import AsyncWriter
+
+
+class AuditLog(AsyncWriter):
+    """An asynchronous, batched and rotated log of executed commands.
+
+    Takes the same keyword arguments as
+    :class:`~shellac.writer.AsyncWriter`.
+
+    :type path: string
+    :param path: File to append audit records to.
+
+    :type user: string
+    :param user: User to record (defaults to the current login name).
+    """
+
+    def __init__(self, path, user=None, **options):
+        self.user = user or getpass.getuser()
+        super(AuditLog, self).__init__(path, **options)
+
+    def log(self, line, start, duration, result=None, error=None):
+        """Queue a record for an executed command line.
+
+        :type line: string
+        :param line: The command line executed.
+
+        :type start: float
+        :param start: Time the command started (seconds since the epoch).
+
+        :type duration: float
+        :param duration: Time taken to execute the command (in seconds).
+
+        :param result: The value returned by onecmd().
+
+        :type error: Exception
+        :param error: The exception raised by the command, if any.
+        """
+
+        if not isinstance(result, (bool, int, float, str, type(None))):
+            result = repr(result)
+        record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                        time.localtime(start)),
+                  'start': start,
+                  'user': self.user,
+                  'line': line,
+                  'duration': duration,
+                  'result': result}
+        if error is not None:
+            record['error'] = repr(error)
+        self.put(json.dumps(record, sort_keys=True) + "\n")
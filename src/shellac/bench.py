@@ -0,0 +1,430 @@
+#!/usr/bin/python
+"""
+Benchmarks
+==========
+
+Micro-benchmarks for the hot paths of shellac, run against synthetic command
+trees of configurable depth and fan-out.
+
+Results are written as JSON so that runs can be compared against each other,
+for example to catch regressions before a release::
+
+    python -m shellac.bench --output baseline.json
+    python -m shellac.bench --compare baseline.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import shellac
+import shellac.fuzzy
+import shellac.parallel
+import shellac.server
+
+
+def make_tree(depth=3, fanout=10, candidates=0, base=shellac.Shellac,
+              name='BenchShell'):
+    """Build a synthetic Shellac subclass with a regular command tree.
+
+    Every level contains *fanout* do_* members named ``c0``, ``c1``, ...
+    which are classes for all but the deepest level, where they are
+    static methods. If *candidates* is non-zero, every leaf has a completer
+    which draws from a shared list of that many names.
+
+    :type depth: int
+    :param depth: Number of command levels in the tree.
+
+    :type fanout: int
+    :param fanout: Number of do_* members at each level.
+
+    :type candidates: int
+    :param candidates: Size of the leaf completion candidate list.
+
+    :type base: class
+    :param base: Class the generated shell inherits from.
+
+    :type name: string
+    :param name: Name of the generated class.
+
+    :return: class
+    """
+
+    names = ['cand%07d' % i for i in range(candidates)]
+
+    def list_candidates(token):
+        return shellac.complete_list(names, token)
+
+    def leaf(label):
+        def do_leaf(args):
+            return None
+        do_leaf.__doc__ = "Leaf command %s." % label
+        if candidates:
+            do_leaf = shellac.completer(list_candidates)(do_leaf)
+        return staticmethod(do_leaf)
+
+    def level(remaining, label):
+        attrs = {'__doc__': "Command group %s." % (label or name)}
+        for i in range(fanout):
+            child = '%s c%d' % (label, i) if label else 'c%d' % i
+            if remaining > 1:
+                attrs['do_c%d' % i] = type('do_c%d' % i, (object,),
+                                           level(remaining - 1, child))
+            else:
+                attrs['do_c%d' % i] = leaf(child)
+        return attrs
+
+    return type(name, (base,), level(depth, ''))
+
+
+def _timed(func, number, repeat):
+    """Return the best time per call of func over repeat runs of number
+    calls."""
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_onecmd(shell, opts):
+    """Dispatch a command line to the deepest leaf."""
+
+    line = ' '.join(['c%d' % (opts.fanout - 1)] * opts.depth) + ' arg'
+    return lambda: shell.onecmd(line)
+
+
+def bench_traverse_do(shell, opts):
+    """Complete a partial subcommand at the deepest level."""
+
+    tokens = ['c%d' % (opts.fanout - 1)] * (opts.depth - 1) + ['c']
+    return lambda: list(shell._traverse_do(tokens, shell))
+
+
+def bench_traverse_do_candidates(shell, opts):
+    """Complete a leaf argument from the candidate list."""
+
+    tokens = ['c0'] * opts.depth + ['cand00001']
+    return lambda: list(shell._traverse_do(tokens, shell))
+
+
+def bench_get_help(shell, opts):
+    """Look up the help for the deepest leaf."""
+
+    args = ' '.join(['c%d' % (opts.fanout - 1)] * opts.depth)
+    return lambda: shell._get_help(args, shell)
+
+
+def bench_complete_list(shell, opts):
+    """Filter the full candidate list by prefix."""
+
+    names = ['cand%07d' % i for i in range(opts.candidates)]
+    return lambda: list(shellac.complete_list(names, 'cand00001'))
+
+
+def bench_fuzzy_search(shell, opts):
+    """Rank the full candidate list against a fuzzy query."""
+
+    index = shellac.fuzzy.FuzzyIndex('cand%07d' % i
+                                     for i in range(opts.candidates))
+    return lambda: index.search('cd99', limit=20)
+
+
+def session_memory(tree, count=1000):
+    """Measure the memory allocated per Session and per Shellac instance.
+
+    :type tree: class
+    :param tree: Shellac subclass to instantiate.
+
+    :type count: int
+    :param count: Number of instances to create for each measurement.
+
+    :return: dict of bytes per 'session' and per 'shell'
+    """
+
+    shell = tree(stdin=io.StringIO(), stdout=io.StringIO())
+    result = {}
+    for name, factory in (('session', lambda: shellac.Session(shell)),
+                          ('shell', lambda: tree(stdin=shell.stdin,
+                                                 stdout=shell.stdout))):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        instances = [factory() for _ in range(count)]
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        result[name] = (after - before) / float(count)
+        del instances
+    return result
+
+
+def server_throughput(tree, clients=8, requests=200, depth=3, fanout=10):
+    """Measure the time per command seen by clients of a shellac server
+    running over a UNIX domain socket.
+
+    :type tree: class
+    :param tree: Shellac subclass to serve.
+
+    :type clients: int
+    :param clients: Number of concurrent client connections.
+
+    :type requests: int
+    :param requests: Number of commands each client runs.
+
+    :return: dict with 'usec' (wall time per command across all clients)
+             and 'ops' (commands per second)
+    """
+
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'bench.sock')
+    shell = tree(stdin=io.StringIO(), stdout=io.StringIO())
+    server = shellac.server.make_server(shell, path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    line = ' '.join(['c%d' % (fanout - 1)] * depth) + ' arg'
+
+    def client():
+        with shellac.server.Client(path) as conn:
+            for _ in range(requests):
+                conn.run(line)
+
+    try:
+        workers = [threading.Thread(target=client) for _ in range(clients)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = (time.perf_counter() - start) / (clients * requests)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        shutil.rmtree(tmpdir)
+    return {'usec': elapsed * 1e6, 'ops': 1.0 / elapsed}
+
+
+def script_scaling(tree, processes=4, lines=2000, spin=2000):
+    """Compare the time per line of a script run by a single shell with
+    onecmd() and by :func:`shellac.parallel.run`.
+
+    Each line runs a command which does a fixed amount of CPU work.
+
+    :type tree: class
+    :param tree: Shellac subclass to extend with the command.
+
+    :type processes: int
+    :param processes: Number of worker processes.
+
+    :type lines: int
+    :param lines: Number of lines in the script.
+
+    :type spin: int
+    :param spin: Size of the loop each command runs.
+
+    :return: dict of 'serial' and 'parallel' results, each with 'usec' (per
+             line) and 'ops' (lines per second)
+    """
+
+    class ScriptShell(tree):
+        @staticmethod
+        def do_spin(args):
+            total = 0
+            for i in range(int(args)):
+                total += i
+            return None
+
+    script = ['spin %d' % spin] * lines
+    shell = ScriptShell(stdin=io.StringIO(), stdout=io.StringIO())
+    start = time.perf_counter()
+    for line in script:
+        shell.onecmd(line)
+    serial = (time.perf_counter() - start) / lines
+    start = time.perf_counter()
+    shellac.parallel.run(
+        lambda: ScriptShell(stdin=io.StringIO(), stdout=io.StringIO()),
+        script, processes, stdout=io.StringIO())
+    parallel = (time.perf_counter() - start) / lines
+    return {'serial': {'usec': serial * 1e6, 'ops': 1.0 / serial},
+            'parallel': {'usec': parallel * 1e6, 'ops': 1.0 / parallel}}
+
+
+def bench_complete_lines(shell, opts):
+    """Complete a batch of 100 lines which share their leading command
+    words."""
+
+    prefix = ' '.join(['c%d' % (opts.fanout - 1)] * (opts.depth - 1))
+    lines = ['%s c%d' % (prefix, i % opts.fanout) for i in range(100)]
+    return lambda: shell.complete_lines(lines)
+
+
+class _PassThrough(shellac.Middleware):
+    """A middleware which does nothing, for timing the chain itself."""
+
+    def __init__(self, applies):
+        self.applies = lambda path, func: applies
+
+
+def _with_middleware(shell, opts, applies):
+    shell = type(shell)(stdin=io.StringIO(), stdout=io.StringIO())
+    for _ in range(getattr(opts, 'middleware', 10)):
+        shell.use(_PassThrough(applies))
+    return bench_onecmd(shell, opts)
+
+
+def bench_onecmd_middleware(shell, opts):
+    """Dispatch a command line through N pass-through middlewares (compare
+    with onecmd for the overhead per command)."""
+
+    return _with_middleware(shell, opts, True)
+
+
+def bench_onecmd_middleware_skipped(shell, opts):
+    """Dispatch a command line with N middlewares which don't apply to it."""
+
+    return _with_middleware(shell, opts, False)
+
+
+BENCHMARKS = [
+    ('onecmd', bench_onecmd),
+    ('onecmd_middleware', bench_onecmd_middleware),
+    ('onecmd_middleware_skipped', bench_onecmd_middleware_skipped),
+    ('traverse_do', bench_traverse_do),
+    ('traverse_do_candidates', bench_traverse_do_candidates),
+    ('complete_lines', bench_complete_lines),
+    ('get_help', bench_get_help),
+    ('complete_list', bench_complete_list),
+    ('fuzzy_search', bench_fuzzy_search),
+]
+
+
+def run(opts, only=None):
+    """Run the benchmarks and return a results dict suitable for saving as
+    JSON.
+
+    :type opts: argparse.Namespace
+    :param opts: Benchmark options (depth, fanout, candidates, number, repeat).
+
+    :type only: list
+    :param only: Names of benchmarks to run (defaults to all).
+
+    :return: dict
+    """
+
+    tree = make_tree(opts.depth, opts.fanout, opts.candidates)
+    shell = tree(stdin=io.StringIO(), stdout=io.StringIO())
+    results = {}
+    for name, setup in BENCHMARKS:
+        if only and name not in only:
+            continue
+        per_call = _timed(setup(shell, opts), opts.number, opts.repeat)
+        results[name] = {'usec': per_call * 1e6,
+                         'ops': 1.0 / per_call if per_call else 0.0}
+    if getattr(opts, 'clients', 0):
+        results['server_%d_clients' % opts.clients] = server_throughput(
+            tree, opts.clients, opts.number, opts.depth, opts.fanout)
+    if getattr(opts, 'processes', 0):
+        scaling = script_scaling(tree, opts.processes)
+        results['script_1_process'] = scaling['serial']
+        results['script_%d_processes' % opts.processes] = scaling['parallel']
+    if not only or 'memory' in only:
+        for name, size in session_memory(tree).items():
+            results[name + '_memory'] = {'bytes': size}
+    return {'meta': {'python': platform.python_version(),
+                     'implementation': platform.python_implementation(),
+                     'depth': opts.depth,
+                     'fanout': opts.fanout,
+                     'candidates': opts.candidates,
+                     'middleware': getattr(opts, 'middleware', 10),
+                     'number': opts.number,
+                     'repeat': opts.repeat,
+                     'time': time.time()},
+            'results': results}
+
+
+def compare(old, new, tolerance=0.2):
+    """Compare two sets of results.
+
+    :type old: dict
+    :param old: Baseline results, as returned by run().
+
+    :type new: dict
+    :param new: Results to check against the baseline.
+
+    :type tolerance: float
+    :param tolerance: Allowed fractional slowdown before a benchmark is
+                      reported as a regression.
+
+    :return: list of (name, old value, new value, ratio) for every
+             regression, where values are usec per call or bytes
+    """
+
+    regressions = []
+    for name, result in sorted(new['results'].items()):
+        base = old['results'].get(name)
+        key = 'usec' if 'usec' in result else 'bytes'
+        if not base or not base.get(key):
+            continue
+        ratio = result[key] / base[key]
+        if ratio > 1 + tolerance:
+            regressions.append((name, base[key], result[key], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--candidates', type=int, default=100000)
+    parser.add_argument('--number', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--clients', type=int, default=0,
+                        help="Also benchmark a server with this many clients")
+    parser.add_argument('--processes', type=int, default=0,
+                        help="Also benchmark a parallel script run with this "
+                             "many processes")
+    parser.add_argument('--middleware', type=int, default=10,
+                        help="Number of middlewares for the "
+                             "onecmd_middleware benchmarks")
+    parser.add_argument('--only', action='append',
+                        help="Only run the named benchmark (repeatable)")
+    parser.add_argument('--output', help="Write results to this JSON file")
+    parser.add_argument('--compare', help="Compare against this JSON file")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    opts = parser.parse_args(argv)
+
+    results = run(opts, opts.only)
+    for name, result in sorted(results['results'].items()):
+        if 'bytes' in result:
+            sys.stdout.write('{0:<28} {1:>12.1f} bytes\n'.format(
+                name, result['bytes']))
+            continue
+        sys.stdout.write('{0:<28} {1:>12.2f} usec {2:>14.1f} ops/s\n'.format(
+            name, result['usec'], result['ops']))
+    if opts.output:
+        with open(opts.output, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    if opts.compare:
+        with open(opts.compare) as base:
+            regressions = compare(json.load(base), results, opts.tolerance)
+        for name, old, new, ratio in regressions:
+            sys.stdout.write('*** REGRESSION {0}: {1:.2f} -> {2:.2f} '
+                             '({3:.0%})\n'.format(name, old, new, ratio - 1))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
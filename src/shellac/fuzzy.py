@@ -0,0 +1,168 @@
+#!/usr/bin/python
+"""
+Fuzzy completion
+================
+
+Subsequence matching and ranking of completion candidates, so that e.g.
+``mbr`` completes to ``member`` and ``grpadd`` to ``group_add``.
+
+A :class:`FuzzyIndex` is built once for a list of names. Names are grouped
+by a bitmask of the characters they contain, so a query only runs its
+regular expression against names which contain all of the query's
+characters. Matches are ranked by:
+
+1. prefix matches, then abbreviations (every character of the query
+   starts a word), then other subsequence matches;
+2. how recently the name was used, if recency is given;
+3. how tightly the query matched, then the length of the name.
+
+An index is built the first time a level of the command tree, or a
+completion function, is fuzzy-matched, and is then reused for every query
+until :func:`invalidate` is called (Shellac does that when commands are
+reloaded and on ``cache clear``) or, for completion functions, whose
+candidates change, until it is *fuzzy_ttl* seconds old.
+
+Fuzzy completion is enabled by setting *fuzzy* on a Shellac instance.
+"""
+
+import heapq
+import re
+import time
+import weakref
+
+
+def _mask(text):
+    """Return a bitmask of the (case-folded) characters in text."""
+
+    mask = 0
+    for char in set(text.lower()):
+        mask |= 1 << (ord(char) & 63)
+    return mask
+
+
+def _pattern(query):
+    """Compile a regular expression which matches query as a subsequence,
+    with a group for every character."""
+
+    return re.compile('.*?'.join('(%s)' % re.escape(char) for char in query),
+                      re.IGNORECASE)
+
+
+def _word_start(name, pos):
+    return pos == 0 or name[pos - 1] in '_- .'
+
+
+def score(query, name, match=None, used=0):
+    """Return a sort key for name as a match for query (lower is better),
+    or None if it doesn't match.
+
+    :type match: re.Match
+    :param match: The result of matching query's pattern against name, if
+                  already known.
+
+    :type used: int
+    :param used: Recency of use (higher is more recent).
+    """
+
+    if match is None:
+        match = _pattern(query).search(name)
+        if match is None:
+            return None
+    if name[:len(query)].lower() == query.lower():
+        tier = 0
+    elif all(_word_start(name, match.start(i + 1))
+             for i in range(len(query))):
+        tier = 1
+    else:
+        tier = 2
+    gaps = match.end() - match.start() - len(query)
+    return (tier, -used, gaps, match.start(), len(name), name)
+
+
+class FuzzyIndex(object):
+    """A precomputed index of names for fuzzy matching.
+
+    :type names: iterable
+    :param names: The names to match against.
+    """
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        by_mask = {}
+        for name in self.names:
+            by_mask.setdefault(_mask(name), []).append(name)
+        self.masks = list(by_mask.items())
+
+    def scored(self, query, recency=None):
+        """Return a list of (key, name) for the names matching query, where
+        key is as returned by :func:`score`.
+
+        :type recency: callable
+        :param recency: Called with a name; returns how recently it was used
+                        (higher is more recent).
+        """
+
+        need = _mask(query)
+        pattern = _pattern(query)
+        found = []
+        for mask, names in self.masks:
+            if need & ~mask:
+                continue
+            for name in names:
+                match = pattern.search(name)
+                if match is not None:
+                    found.append((score(query, name, match,
+                                        recency(name) if recency else 0),
+                                  name))
+        return found
+
+    def search(self, query, recency=None, limit=None):
+        """Return the names matching query, best first.
+
+        :type limit: int
+        :param limit: Maximum number of names to return.
+
+        :return: list
+        """
+
+        found = self.scored(query, recency)
+        if limit is not None:
+            found = heapq.nsmallest(limit, found)
+        else:
+            found.sort()
+        return [name for _, name in found]
+
+
+# Indexes of the names at each level of command trees, and of the
+# candidates of completion functions
+_indexes = weakref.WeakKeyDictionary()
+
+
+def index(key, names, ttl=None):
+    """Return the FuzzyIndex cached for key, building it the first time.
+
+    :param key: A class or function to cache the index against.
+
+    :type names: callable
+    :param names: Called with no arguments to get the names to index, only
+                  if there is no cached index.
+
+    :type ttl: float
+    :param ttl: Rebuild the index once it is this many seconds old (None
+                to keep it until invalidated).
+    """
+
+    now = time.monotonic()
+    cached = _indexes.get(key)
+    if cached is None or (ttl is not None and cached[1] + ttl <= now):
+        cached = _indexes[key] = (FuzzyIndex(names()), now)
+    return cached[0]
+
+
+def invalidate(key=None):
+    """Discard the cached index for key, or all cached indexes."""
+
+    if key is None:
+        _indexes.clear()
+    else:
+        _indexes.pop(key, None)
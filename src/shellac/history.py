@@ -0,0 +1,261 @@
+#!/usr/bin/python
+"""
+Command history
+===============
+
+A persistent, append-only command history with fast prefix and substring
+search over very large numbers of entries.
+
+Entries are stored one per line. Writes go through a background
+:class:`shellac.writer.AsyncWriter`, so adding an entry never waits on disk.
+When the file grows to twice *maxlen* entries it is compacted to the most
+recent *maxlen*, also in the background.
+
+For searching, entries are kept in a single newline-joined string with an
+array of entry offsets, so that searches are done by the C implementations
+of str.find()/str.rfind() rather than a Python loop over the entries.
+
+History is enabled by setting *history_file* on a Shellac instance.
+"""
+
+import array
+import bisect
+import functools
+import os
+import threading
+
+from shellac.writer import AsyncWriter
+
+
+class History(object):
+    """A persistent command history.
+
+    :type path: string
+    :param path: File to keep the history in.
+
+    :type maxlen: int
+    :param maxlen: Number of entries to keep when the file is compacted.
+    """
+
+    #: Number of new entries kept outside the search index
+    tail_size = 1000
+
+    def __init__(self, path, maxlen=1000000):
+        self.path = path
+        self.maxlen = maxlen
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.text = "\n"
+        self.offsets = array.array('l')
+        self.tail = []
+        self.writer = None
+        self.written = 0
+        self.compacting = False
+
+    def load(self):
+        """Read the history file and build the search index.
+
+        Compacts the file first if it has grown too large.
+        """
+
+        try:
+            with open(self.path) as hist:
+                entries = hist.read().splitlines()
+        except (IOError, OSError):
+            entries = []
+        if len(entries) > self.maxlen:
+            entries = entries[-self.maxlen:]
+            self._rewrite(entries)
+        with self.lock:
+            # Keep entries added while the file was being read
+            pending = self.tail
+            self._index(entries)
+            self.written = len(entries)
+            self.writer = AsyncWriter(self.path, batch_size=20)
+        for line in pending:
+            self.append(line)
+        self.loaded.set()
+
+    def load_async(self):
+        """Load the history in a background thread.
+
+        :return: threading.Thread
+        """
+
+        thread = threading.Thread(target=self.load, name="shellac history")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _rewrite(self, entries):
+        """Atomically replace the history file with the given entries."""
+
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as hist:
+            hist.write(''.join(entry + "\n" for entry in entries))
+        os.rename(tmp, self.path)
+
+    def _index(self, entries):
+        """Build the search text and offsets from a list of entries."""
+
+        self.text = "\n" + "".join(entry + "\n" for entry in entries)
+        self.offsets = array.array('l')
+        pos = 1
+        for entry in entries:
+            self.offsets.append(pos)
+            pos += len(entry) + 1
+        self.tail = []
+
+    def __len__(self):
+        return len(self.offsets) + len(self.tail)
+
+    def __getitem__(self, index):
+        """Return an entry by index (oldest first)."""
+
+        with self.lock:
+            if index < 0:
+                index += len(self)
+            if index >= len(self.offsets):
+                return self.tail[index - len(self.offsets)]
+            start = self.offsets[index]
+            return self.text[start:self.text.index("\n", start)]
+
+    def append(self, line):
+        """Add an entry. The file is written in the background."""
+
+        line = line.replace("\n", " ")
+        if not line.strip():
+            return
+        with self.lock:
+            self.tail.append(line)
+            if len(self.tail) > self.tail_size:
+                self._merge()
+            if self.writer is not None:
+                self.writer.put(line + "\n")
+                self.written += 1
+                if self.written >= 2 * self.maxlen and not self.compacting:
+                    self.compacting = True
+                    self.writer.call(functools.partial(self._compact,
+                                                       len(self)))
+
+    def _merge(self):
+        """Move the tail entries into the search index."""
+
+        pos = len(self.text)
+        for entry in self.tail:
+            self.offsets.append(pos)
+            pos += len(entry) + 1
+        self.text += "".join(entry + "\n" for entry in self.tail)
+        self.tail = []
+
+    def _compact(self, count):
+        """Trim the file and index to the most recent maxlen of the first
+        count entries.
+
+        Called by the writer thread (with the file closed) once the first
+        count entries have been written. Entries added meanwhile are kept,
+        and the lock is only held to swap in the trimmed index.
+        """
+
+        try:
+            with self.lock:
+                self._merge()
+                text = self.text
+                offsets = self.offsets
+            keep = min(count, self.maxlen)
+            start = offsets[count - keep]
+            end = offsets[count] if count < len(offsets) else len(text)
+            kept = text[start:end]
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w') as hist:
+                hist.write(kept)
+            os.rename(tmp, self.path)
+            shift = start - 1
+            trimmed = array.array('l', (offset - shift for offset in
+                                        offsets[count - keep:count]))
+            kept = "\n" + kept
+            with self.lock:
+                # Entries merged into the index since it was copied
+                trimmed.extend(offset - shift for offset in offsets[count:])
+                self.text = kept + self.text[end:]
+                self.offsets = trimmed
+                self.written -= count - keep
+        finally:
+            self.compacting = False
+
+    def search(self, text, prefix=False, limit=None):
+        """Search the history, most recent entries first.
+
+        :type text: string
+        :param text: Text to search for.
+
+        :type prefix: boolean
+        :param prefix: If True, only match entries which start with text,
+                       otherwise match text anywhere in an entry.
+
+        :type limit: int
+        :param limit: Maximum number of entries to return.
+
+        :return: generator of (index, entry)
+        """
+
+        with self.lock:
+            tail = list(self.tail)
+            index_text = self.text
+            offsets = self.offsets
+        if limit is None:
+            limit = -1
+        base = len(offsets)
+        for i in range(len(tail) - 1, -1, -1):
+            if limit == 0:
+                return
+            if tail[i].startswith(text) if prefix else text in tail[i]:
+                limit -= 1
+                yield base + i, tail[i]
+        if not text:
+            matches = ((i, offsets[i]) for i in range(base - 1, -1, -1))
+        else:
+            matches = self._find(index_text, offsets, text, prefix)
+        for index, start in matches:
+            if limit == 0:
+                return
+            limit -= 1
+            yield index, index_text[start:index_text.index("\n", start)]
+
+    @staticmethod
+    def _find(index_text, offsets, text, prefix):
+        """Search the index backwards, yielding (index, offset) for every
+        matching entry."""
+
+        needle = "\n" + text if prefix else text
+        end = len(index_text)
+        while True:
+            pos = index_text.rfind(needle, 0, end)
+            if pos < 0:
+                return
+            if prefix:
+                # The match starts at the newline before the entry
+                index = bisect.bisect_right(offsets, pos + 1) - 1
+                end = pos + len(needle) - 1
+            else:
+                index = bisect.bisect_right(offsets, pos) - 1
+                end = offsets[index]
+            yield index, offsets[index]
+
+    def recent(self, count):
+        """Return the last count entries (oldest first)."""
+
+        total = len(self)
+        return [(i, self[i]) for i in range(max(0, total - count), total)]
+
+    def flush(self):
+        """Wait for queued entries to be written to the file."""
+
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        """Write any queued entries to the file and stop the writer."""
+
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+"""
+File-backed completion candidates
+=================================
+
+Completion candidates drawn from very large lists (millions of names) can be
+kept in a sorted, newline-delimited file instead of a Python list. The file
+is memory-mapped and searched by binary search on the prefix, so matches are
+found without reading the file into the heap, and pages are shared between
+all the processes using the same file::
+
+    accounts = MappedCandidates('/var/lib/myshell/accounts.txt')
+
+    class do_account(object):
+        @staticmethod
+        @shellac.completer(accounts)
+        def do_show(args):
+            ...
+
+The file must be sorted by its UTF-8 bytes, with one entry per line, as
+written by :func:`build_sorted`.
+"""
+
+import heapq
+import itertools
+import mmap
+import os
+import tempfile
+
+import shellac
+
+
+class MappedCandidates(object):
+    """A completion function which finds candidates in a sorted file.
+
+    :type path: string
+    :param path: Sorted newline-delimited file of candidates.
+
+    :type append_character: string
+    :param append_character: completion character to append (see
+                             rl.completion.append_character)
+    """
+
+    #: Candidates are returned in sorted order
+    sorted = True
+
+    def __init__(self, path, append_character=" "):
+        self.path = path
+        self.append_character = append_character
+        self.file = open(path, 'rb')
+        if os.fstat(self.file.fileno()).st_size:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        else:
+            # mmap can't map an empty file
+            self.map = b''
+
+    def _line(self, pos):
+        """Return (start, end) of the line containing pos."""
+
+        start = self.map.rfind(b'\n', 0, pos) + 1
+        end = self.map.find(b'\n', pos)
+        return start, len(self.map) if end < 0 else end
+
+    def _bisect(self, key):
+        """Return the offset of the first line which is not less than key."""
+
+        lo, hi = 0, len(self.map)
+        while lo < hi:
+            start, end = self._line((lo + hi) // 2)
+            if self.map[start:end] < key:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+    def matches(self, token):
+        """Return a generator of the candidates which start with token."""
+
+        key = token.encode('utf-8')
+        pos = self._bisect(key)
+        size = len(self.map)
+        while pos < size:
+            end = self.map.find(b'\n', pos)
+            if end < 0:
+                end = size
+            line = self.map[pos:end]
+            if not line.startswith(key):
+                return
+            yield line.decode('utf-8')
+            pos = end + 1
+
+    def __call__(self, token):
+        shellac.set_append_character(self.append_character)
+        return self.matches(token)
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+
+def _write_run(lines, directory):
+    """Write sorted lines to a temporary file and return its name."""
+
+    handle, name = tempfile.mkstemp(dir=directory, suffix='.run')
+    with os.fdopen(handle, 'wb') as run:
+        run.writelines(line + b'\n' for line in sorted(lines))
+    return name
+
+
+def _read_run(name):
+    with open(name, 'rb') as run:
+        for line in run:
+            yield line.rstrip(b'\n')
+
+
+def build_sorted(lines, path, chunk_size=1000000):
+    """Write candidates to a file suitable for MappedCandidates.
+
+    Lines are sorted by their UTF-8 bytes and duplicates and blank lines are
+    removed. Input is sorted in chunks of *chunk_size* lines which are then
+    merged, so memory use is bounded however many lines there are.
+
+    :type lines: iterable
+    :param lines: Candidate strings, e.g. an open file.
+
+    :type path: string
+    :param path: File to write (replaced atomically).
+
+    :type chunk_size: int
+    :param chunk_size: Number of lines to sort in memory at once.
+    """
+
+    directory = os.path.dirname(os.path.abspath(path))
+    runs = []
+    try:
+        lines = (line.rstrip('\r\n').encode('utf-8') for line in lines)
+        lines = (line for line in lines if line.strip())
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if not chunk:
+                break
+            runs.append(_write_run(chunk, directory))
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as out:
+            last = None
+            for line in heapq.merge(*[_read_run(run) for run in runs]):
+                if line != last:
+                    out.write(line + b'\n')
+                    last = line
+        os.rename(tmp, path)
+    finally:
+        for run in runs:
+            os.remove(run)
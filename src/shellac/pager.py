@@ -0,0 +1,121 @@
+#!/usr/bin/python
+"""
+Pager
+=====
+
+A built-in pager which shows long command output one screen at a time, as
+it is produced.
+
+Paging is enabled by setting *pager* on a Shellac instance, to True or to
+the number of lines per screen. While a command runs on a terminal, its
+output (including print()) goes through a :class:`Pager`, and so do the
+items of a generator returned by the command, which are only computed as
+they are shown. After every screen the user is prompted, and can press
+Enter for the next screen, enter ``q`` to quit, or ``/text`` to search the
+output shown so far. Quitting raises :class:`PagerQuit` from the next
+write, which stops the command, so the rest of its output is never
+produced.
+"""
+
+import collections
+import shutil
+
+
+class PagerQuit(Exception):
+    """Raised by Pager.write() once the user has quit paging."""
+
+
+class Pager(object):
+    """A file-like object which writes to a terminal a screen at a time.
+
+    :type stream: File-like object
+    :param stream: The terminal to write to.
+
+    :type input: File-like object
+    :param input: Where the user's answers to the prompt are read from.
+
+    :type height: int
+    :param height: Lines per screen (defaults to the terminal height, less
+                   one line for the prompt).
+
+    :type buffer_size: int
+    :param buffer_size: Number of lines kept for searching.
+    """
+
+    prompt = "--More-- (Enter: next page, q: quit, /text: search) "
+
+    def __init__(self, stream, input, height=None, buffer_size=100000):
+        self.stream = stream
+        self.input = input
+        if height is None:
+            height = shutil.get_terminal_size().lines - 1
+        self.height = max(height, 1)
+        self.lines = collections.deque(maxlen=buffer_size)
+        self.total = 0
+        self.shown = 0
+        self.partial = ''
+        self.quit = False
+
+    def write(self, data):
+        if self.quit:
+            raise PagerQuit()
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self._line(line)
+
+    def _line(self, line):
+        if self.shown >= self.height:
+            self._more()
+        self.stream.write(line + "\n")
+        self.lines.append(line)
+        self.total += 1
+        self.shown += 1
+
+    def _more(self):
+        """Prompt at the end of a screen until the user asks for the next
+        one, raising PagerQuit if they quit."""
+
+        while True:
+            self.stream.write(self.prompt)
+            self.stream.flush()
+            answer = self.input.readline()
+            if not answer or answer.strip().lower() == 'q':
+                self.stream.write("\n")
+                self.quit = True
+                raise PagerQuit()
+            answer = answer.rstrip('\r\n')
+            if answer.startswith('/'):
+                self.search(answer[1:])
+                continue
+            self.shown = 0
+            return
+
+    def search(self, text):
+        """Show the buffered lines which contain text, with their line
+        numbers (at most a screen of the most recent)."""
+
+        first = self.total - len(self.lines) + 1
+        found = [(first + i, line) for i, line in enumerate(self.lines)
+                 if text in line]
+        if not found:
+            self.stream.write("Pattern not found: {0}\n".format(text))
+        for number, line in found[-self.height:]:
+            self.stream.write("{0:>6}  {1}\n".format(number, line))
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        """Write any unfinished last line."""
+
+        if self.partial and not self.quit:
+            self._line(self.partial)
+        self.partial = ''
+        self.stream.flush()
+
+    def isatty(self):
+        return self.stream.isatty()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
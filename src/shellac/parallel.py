@@ -0,0 +1,256 @@
+#!/usr/bin/python
+"""
+Parallel scripts
+================
+
+Run a large script of independent command lines on several cores at once.
+
+Lines are sent, in chunks, to a pool of worker processes which are forked
+when the run starts. Each worker creates its own shell instance, runs its
+lines through precmd(), onecmd() and postcmd() and sends back what each
+line printed. Output is written in the original line order: results which
+arrive early wait in a reordering buffer, and no more than *window* lines
+are in flight at once, so memory use stays bounded whatever the size of
+the script.
+
+Commands which must not run concurrently with others (e.g. because they
+depend on the effects of earlier lines) are marked with
+:func:`shellac.serial`. Before such a line is run, every earlier line is
+finished, and the line itself is run in the parent process.
+
+Note that workers don't share state, and that lines after one which stops
+the script (e.g. ``exit``) may already have been run by the time the stop
+is seen. A script can be run from the command line::
+
+    python -m shellac.parallel script.txt mymodule:MyShell --processes 8
+"""
+
+import argparse
+import functools
+import importlib
+import io
+import multiprocessing
+import os
+import queue
+import sys
+import traceback
+
+import shellac
+
+
+class ScriptError(Exception):
+    """Raised when a line of a parallel script raised an exception.
+
+    :ivar index: Line number (from 0).
+    :ivar line: The command line.
+    :ivar traceback: The formatted traceback from the worker.
+    """
+
+    def __init__(self, index, line, tb):
+        super(ScriptError, self).__init__(
+            "line {0}: {1}\n{2}".format(index + 1, line, tb))
+        self.index = index
+        self.line = line
+        self.traceback = tb
+
+
+def _run_line(shell, line):
+    """Run a line, capturing its output.
+
+    :return: (output, stop, traceback or None)
+    """
+
+    out = io.StringIO()
+    shell.stdout = out
+    with shellac.redirect_stdout(out):
+        try:
+            line = shell.precmd(line)
+            stop = shell.onecmd(line)
+            stop = shell.postcmd(stop, line)
+        except Exception:
+            return out.getvalue(), None, traceback.format_exc()
+    return out.getvalue(), bool(stop), None
+
+
+def _worker(factory, tasks, results):
+    """Worker process: run chunks of (index, line) until told to stop."""
+
+    shell = factory()
+    shell.preloop()
+    try:
+        for chunk in iter(tasks.get, None):
+            results.put([(index, line) + _run_line(shell, line)
+                         for index, line in chunk])
+        shell.postloop()
+    finally:
+        shell._flush_logs()
+
+
+def _is_serial(shell, line):
+    """Return True if line calls a command marked with @serial."""
+
+    found = shell._resolve(line) if line else None
+    return bool(found and getattr(found[1], 'serial', False))
+
+
+def _context(start_method=None):
+    """Return a multiprocessing context which forks, where possible, so
+    that workers start quickly and the shell class needn't be importable
+    by name."""
+
+    if start_method is None and \
+            'fork' in multiprocessing.get_all_start_methods():
+        start_method = 'fork'
+    return multiprocessing.get_context(start_method)
+
+
+def _make_shell(cls):
+    """Create a shell for a script run from the command line (a module
+    level function, so that it can be pickled for spawned workers)."""
+
+    return cls(stdin=io.StringIO())
+
+
+def run(factory, lines, processes=None, window=1000, chunk_size=20,
+        stdout=None, start_method=None):
+    """Run command lines across a pool of worker processes.
+
+    :type factory: callable
+    :param factory: Called with no arguments to create a shell, once in
+                    each worker and once in this process (for @serial
+                    commands). It must be picklable unless workers are
+                    forked.
+
+    :type lines: iterable
+    :param lines: Command lines, e.g. an open file.
+
+    :type processes: int
+    :param processes: Number of workers (defaults to the number of CPUs).
+
+    :type window: int
+    :param window: Maximum number of lines run or waiting to be written at
+                   once.
+
+    :type chunk_size: int
+    :param chunk_size: Number of lines sent to a worker at a time.
+
+    :type stdout: File-like object
+    :param stdout: Where output is written (defaults to sys.stdout).
+
+    :type start_method: string
+    :param start_method: multiprocessing start method for the workers
+                         (defaults to 'fork' where available).
+
+    :raises ScriptError: if a line raised an exception.
+
+    :return: True if a command stopped the script, otherwise None
+    """
+
+    if stdout is None:
+        stdout = sys.stdout
+    window = max(window, chunk_size)
+    ctx = _context(start_method)
+    tasks = ctx.Queue()
+    results = ctx.Queue()
+    workers = [ctx.Process(target=_worker, args=(factory, tasks, results),
+                           name="shellac worker %d" % i)
+               for i in range(processes or os.cpu_count() or 1)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    shell = factory()
+    shell.preloop()
+    state = {'sent': 0, 'written': 0}
+    reorder = {}
+    chunk = []
+
+    def submit():
+        if chunk:
+            tasks.put(list(chunk))
+            del chunk[:]
+
+    def write(index, line, output, stop, tb):
+        stdout.write(output)
+        state['written'] = index + 1
+        if tb is not None:
+            raise ScriptError(index, line, tb)
+        return stop
+
+    def collect():
+        """Wait for a chunk of results and write those now in order."""
+
+        while True:
+            try:
+                done = results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in workers):
+                    raise ScriptError(state['written'], None,
+                                      "worker process exited")
+        for result in done:
+            reorder[result[0]] = result
+        while state['written'] in reorder:
+            if write(*reorder.pop(state['written'])):
+                return True
+
+    finished = False
+    try:
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if _is_serial(shell, line):
+                submit()
+                while state['written'] < state['sent']:
+                    if collect():
+                        return True
+                state['sent'] += 1
+                if write(state['sent'] - 1, line, *_run_line(shell, line)):
+                    return True
+                continue
+            chunk.append((state['sent'], line))
+            state['sent'] += 1
+            if len(chunk) >= chunk_size:
+                submit()
+            while state['sent'] - state['written'] >= window:
+                submit()
+                if collect():
+                    return True
+        submit()
+        while state['written'] < state['sent']:
+            if collect():
+                return True
+        shell.postloop()
+        finished = True
+    finally:
+        shell._flush_logs()
+        stdout.flush()
+        if finished:
+            for worker in workers:
+                tasks.put(None)
+        for worker in workers:
+            worker.join(None if finished else 0)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run a shellac script on several cores.")
+    parser.add_argument('script', help="File of command lines")
+    parser.add_argument('shell', help="Shell class as module:Class")
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--window', type=int, default=1000)
+    parser.add_argument('--start-method',
+                        choices=multiprocessing.get_all_start_methods())
+    opts = parser.parse_args(argv)
+
+    modname, clsname = opts.shell.split(':', 1)
+    cls = getattr(importlib.import_module(modname), clsname)
+    with open(opts.script) as script:
+        run(functools.partial(_make_shell, cls), script, opts.processes,
+            opts.window, start_method=opts.start_method)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
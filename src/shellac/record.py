@@ -0,0 +1,309 @@
+#!/usr/bin/python
+"""
+Session recording
+=================
+
+Record an interactive session to an append-only file and replay it later,
+for load testing and before/after latency comparisons.
+
+Every event is written as a single JSON object on its own line, with a
+*kind* of ``line`` (an input line), ``complete`` (a completion request and
+its matches) or ``output`` (everything written while a line was executed),
+and a timestamp *t*.
+
+Recording is enabled with :meth:`shellac.Shellac.record`. A recording can be
+replayed from the command line::
+
+    python -m shellac.record session.log mymodule:MyShell --concurrency 8
+"""
+
+import argparse
+import atexit
+import importlib
+import io
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+
+class Tee(object):
+    """A file-like object which writes to a stream and keeps a copy of
+    everything written.
+
+    :type stream: File-like object
+    :param stream: Stream to pass writes through to.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.copy = io.StringIO()
+
+    def write(self, data):
+        self.copy.write(data)
+        return self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class Recorder(object):
+    """Append session events to a file, one JSON object per line.
+
+    The file is closed by close(), on leaving a with block, or at exit.
+
+    :type path: string
+    :param path: File to append events to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.out = open(path, 'a')
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def event(self, kind, **fields):
+        """Append a single event of the given kind."""
+
+        fields['kind'] = kind
+        fields['t'] = time.time()
+        data = json.dumps(fields, sort_keys=True) + "\n"
+        with self.lock:
+            if self.out.closed:
+                return
+            self.out.write(data)
+            self.out.flush()
+
+    def line(self, line):
+        """Record an input line."""
+
+        self.event('line', line=line)
+
+    def completion(self, buf, endidx, matches):
+        """Record a completion request and the matches returned."""
+
+        self.event('complete', buf=buf, endidx=endidx, matches=matches)
+
+    def output(self, line, text):
+        """Record the output written while executing line."""
+
+        self.event('output', line=line, text=text)
+
+    def capture(self, shell, line):
+        """Return a context manager which records everything written to
+        shell.stdout and sys.stdout while line is executed."""
+
+        return _Capture(self, shell, line)
+
+    def close(self):
+        """Close the file. Further events are discarded."""
+
+        with self.lock:
+            self.out.close()
+        atexit.unregister(self.close)
+
+
+class _Capture(object):
+    """Swap shell.stdout for a Tee while a line executes, and redirect
+    sys.stdout to a Tee for the current thread only."""
+
+    def __init__(self, recorder, shell, line):
+        self.recorder = recorder
+        self.shell = shell
+        self.line = line
+
+    def __enter__(self):
+        from shellac import redirect_stdout, _real_stdout
+
+        self.stdout = self.shell.stdout
+        self.tee = Tee(self.stdout)
+        self.shell.stdout = self.tee
+        sys_stdout = _real_stdout()
+        self.sys_tee = self.tee
+        if sys_stdout is not self.stdout:
+            self.sys_tee = Tee(sys_stdout)
+        self.redirect = redirect_stdout(self.sys_tee)
+        self.redirect.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.redirect.__exit__(*exc)
+        self.shell.stdout = self.stdout
+        text = self.tee.copy.getvalue()
+        if self.sys_tee is not self.tee:
+            text += self.sys_tee.copy.getvalue()
+        self.recorder.output(self.line, text)
+
+
+def load(path):
+    """Return a list of the events in a recording.
+
+    :type path: string
+    :param path: Recording file.
+
+    :return: list
+    """
+
+    with open(path) as recording:
+        return [json.loads(data) for data in recording if data.strip()]
+
+
+def summary(latencies):
+    """Summarise a list of latencies (in seconds).
+
+    :return: dict with count, mean, p50, p95, p99 and max in milliseconds
+    """
+
+    if not latencies:
+        return {'count': 0}
+    ordered = sorted(latencies)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1e3
+
+    return {'count': len(ordered),
+            'mean': sum(ordered) / len(ordered) * 1e3,
+            'p50': pct(0.50),
+            'p95': pct(0.95),
+            'p99': pct(0.99),
+            'max': ordered[-1] * 1e3}
+
+
+def _replay_one(events, shell, paced, lines, completions):
+    """Feed events through a single shell, appending latencies to the lines
+    and completions lists."""
+
+    start = time.time()
+    first = events[0]['t'] if events else 0
+    for event in events:
+        if paced:
+            delay = (event['t'] - first) - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        if event['kind'] == 'line':
+            began = time.perf_counter()
+            line = shell.precmd(event['line'])
+            stop = shell.onecmd(line)
+            stop = shell.postcmd(stop, line)
+            lines.append(time.perf_counter() - began)
+            if stop:
+                break
+        elif event['kind'] == 'complete':
+            began = time.perf_counter()
+            _replay_completion(shell, event['buf'], event['endidx'])
+            completions.append(time.perf_counter() - began)
+
+
+def _replay_completion(shell, buf, endidx):
+    """Complete a line as Tab would, reading at most completion_limit + 1
+    candidates, but without touching readline (shared by every thread), so
+    too_many_matches() is not called."""
+
+    from shellac import _detached
+
+    detached = _detached.set(True)
+    try:
+        matches = shell._complete_line(buf, endidx)
+        limit = shell.completion_limit
+        if limit is not None:
+            matches = itertools.islice(matches, limit + 1)
+        return list(matches)
+    finally:
+        _detached.reset(detached)
+
+
+def _replay_thread(errors, quiet, *args):
+    """Run _replay_one() in a worker thread, with sys.stdout discarded if
+    quiet, appending any exception raised to the errors list."""
+
+    from shellac import redirect_stdout
+
+    try:
+        if not quiet:
+            return _replay_one(*args)
+        with open(os.devnull, 'w') as devnull:
+            with redirect_stdout(devnull):
+                return _replay_one(*args)
+    except Exception as exc:
+        errors.append(exc)
+
+
+def replay(events, factory, paced=False, concurrency=1, quiet=True):
+    """Replay a recording through precmd(), onecmd() and postcmd().
+
+    :type events: list or string
+    :param events: Events as returned by load(), or a recording file.
+
+    :type factory: callable
+    :param factory: Called with no arguments to create each shell instance.
+
+    :type paced: boolean
+    :param paced: If True, keep to the original timing between events,
+                  otherwise replay as fast as possible.
+
+    :type concurrency: int
+    :param concurrency: Number of shell instances replaying the recording
+                        at the same time, each in its own thread.
+
+    :type quiet: boolean
+    :param quiet: Discard anything written to sys.stdout during replay.
+
+    :return: dict with summary() results for 'lines' and 'completions', and
+             the total elapsed 'time' in seconds
+
+    If a shell raises an exception, the other shells finish replaying and
+    the first exception is then raised.
+    """
+
+    if not isinstance(events, list):
+        events = load(events)
+    lines = []
+    completions = []
+    errors = []
+    shells = [factory() for _ in range(concurrency)]
+    threads = [threading.Thread(target=_replay_thread,
+                                args=(errors, quiet, events, shell, paced,
+                                      lines, completions))
+               for shell in shells]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return {'lines': summary(lines),
+            'completions': summary(completions),
+            'time': time.perf_counter() - start}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a shellac session.")
+    parser.add_argument('recording', help="Recorded session file")
+    parser.add_argument('shell', help="Shell class as module:Class")
+    parser.add_argument('--paced', action='store_true',
+                        help="Keep to the original timing")
+    parser.add_argument('--concurrency', type=int, default=1)
+    opts = parser.parse_args(argv)
+
+    modname, clsname = opts.shell.split(':', 1)
+    cls = getattr(importlib.import_module(modname), clsname)
+    result = replay(opts.recording,
+                    lambda: cls(stdin=io.StringIO(), stdout=open(os.devnull, 'w')),
+                    opts.paced, opts.concurrency)
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+"""
+Socket server
+=============
+
+Serve a single, warm shell to many clients over a UNIX domain socket or TCP,
+instead of starting a new process for every script or cron job.
+
+The protocol is line based. Each request is a single line:
+
+* A command line, which is run through precmd(), onecmd() and postcmd() in
+  the connection's own :class:`shellac.Session`. Its output is sent back.
+* A TAB character followed by a partial command line, which is a completion
+  request. The possible completions are sent back, one per line.
+
+If a request raises an exception, the error is sent back after any output,
+and the connection stays open.
+
+Every response is followed by a line containing only :data:`END`. The
+connection is closed when a command returns a stop flag (e.g. ``exit``) or
+the client disconnects.
+
+A server is normally started with :meth:`shellac.Shellac.serve`.
+"""
+
+import os
+import socket
+import socketserver
+import stat
+
+import shellac
+
+
+#: Prefix for completion requests
+COMPLETE = "\t"
+
+#: Line which marks the end of each response
+END = "\0"
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """Run the requests from one client in its own Session."""
+
+    def handle(self):
+        stdin = self.connection.makefile('r', encoding='utf-8', newline='\n')
+        stdout = self.connection.makefile('w', encoding='utf-8')
+        session = shellac.Session(self.server.shell, stdin=stdin,
+                                  stdout=stdout, prompt='')
+        try:
+            with shellac.redirect_stdout(stdout):
+                session.preloop()
+                try:
+                    self.run(session)
+                finally:
+                    session.postloop()
+                    session._flush_logs()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            stdin.close()
+            stdout.close()
+
+    def run(self, session):
+        """Handle requests until the client disconnects or a command stops
+        the session."""
+
+        stop = None
+        while not stop:
+            line = session.stdin.readline()
+            if not line:
+                break
+            line = line.rstrip('\r\n')
+            try:
+                if line.startswith(COMPLETE):
+                    line = line[len(COMPLETE):]
+                    for match in session.complete_line(line):
+                        session.stdout.write(match + "\n")
+                else:
+                    line = session.precmd(line)
+                    stop = session.onecmd(line)
+                    stop = session.postcmd(stop, line)
+            except Exception as exc:
+                self.error(session, line, exc)
+            session.stdout.write(END + "\n")
+            session.stdout.flush()
+
+
+    def error(self, session, line, exc):
+        """Report a request which raised an exception to the client; the
+        connection stays open.
+
+        *Can be overridden*.
+        """
+
+        session.stdout.write("*** {0}: {1}\n".format(type(exc).__name__,
+                                                     exc))
+
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixServer(socketserver.ThreadingMixIn,
+                 socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(shell, address):
+    """Create (but don't start) a threaded server for the given shell.
+
+    :type shell: Shellac
+    :param shell: The shell instance shared by all connections.
+
+    :type address: string, int or tuple
+    :param address: A UNIX domain socket path, a TCP port on localhost,
+                    or a (host, port) tuple.
+
+    :return: socketserver.BaseServer
+    """
+
+    if isinstance(address, int):
+        address = ('127.0.0.1', address)
+    if isinstance(address, tuple):
+        server = TCPServer(address, Handler)
+    else:
+        # Remove a socket left behind by a previous server
+        try:
+            if stat.S_ISSOCK(os.stat(address).st_mode):
+                os.remove(address)
+        except OSError:
+            pass
+        server = UnixServer(address, Handler)
+    server.shell = shell
+    return server
+
+
+class Client(object):
+    """A simple client for a shellac server.
+
+    :type address: string, int or tuple
+    :param address: The address the server is listening on (see
+                    make_server()).
+    """
+
+    def __init__(self, address):
+        if isinstance(address, int):
+            address = ('127.0.0.1', address)
+        if isinstance(address, tuple):
+            self.sock = socket.create_connection(address)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+        self.rfile = self.sock.makefile('r', encoding='utf-8', newline='\n')
+        self.wfile = self.sock.makefile('w', encoding='utf-8')
+
+    def _request(self, line):
+        self.wfile.write(line + "\n")
+        self.wfile.flush()
+        lines = []
+        for response in self.rfile:
+            if response.endswith(END + "\n"):
+                if len(response) > len(END) + 1:
+                    lines.append(response[:-len(END) - 1])
+                break
+            lines.append(response)
+        return lines
+
+    def run(self, line):
+        """Run a command line on the server and return its output."""
+
+        return ''.join(self._request(line))
+
+    def complete(self, line):
+        """Return a list of possible completions for a partial line."""
+
+        return [match.rstrip("\n") for match in self._request(COMPLETE + line)]
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -6,9 +6,27 @@ If this script is executed, it will run a simple User & Group tool demo.
 """
 
 from unittest import TestCase
+import argparse
+import bisect
+import io
+import itertools
+import json
+import os
 import rl
 import shellac
+import shellac.audit
+import shellac.bench
+import shellac.fuzzy
+import shellac.history
+import shellac.mapped
+import shellac.pager
+import shellac.parallel
+import shellac.record
+import shellac.server
+import shutil
 import sys
+import tempfile
+import threading
 import time
 
 class ShellacTests(TestCase):
@@ -22,6 +40,1686 @@ class ShellacTests(TestCase):
                          ["bat", "bird"])
 
 
+class BenchTests(TestCase):
+
+    def setUp(self):
+        self.opts = argparse.Namespace(depth=2, fanout=3, candidates=50,
+                                       number=2, repeat=1)
+
+    def test_make_tree(self):
+        tree = shellac.bench.make_tree(depth=2, fanout=3, candidates=5)
+        self.assertEqual(list(shellac.members(tree.do_c2)),
+                         ["c0", "c1", "c2"])
+        self.assertEqual(list(tree.do_c1.do_c0.completions[0]("cand0000003")),
+                         ["cand0000003"])
+
+    def test_run_and_compare(self):
+        results = shellac.bench.run(self.opts)
+        self.assertEqual(set(results['results']),
+                         set(name for name, _ in shellac.bench.BENCHMARKS) |
+                         set(["session_memory", "shell_memory"]))
+        slower = {'results': dict((k, dict((n, x * 2) for n, x in v.items()))
+                                  for k, v in results['results'].items())}
+        self.assertEqual(len(shellac.bench.compare(results, slower)),
+                         len(results['results']))
+        self.assertEqual(shellac.bench.compare(results, results), [])
+
+
+class RecordTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "session.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def new_tool(self):
+        return UserGroupTool(stdin=io.StringIO(), stdout=io.StringIO())
+
+    def test_record_and_replay(self):
+        tool = self.new_tool()
+        with tool.record(self.path) as recorder:
+            recorder.completion("group l", 7, ["list"])
+            tool.cmdqueue = ["exit", "group list"]
+            tool.cmdloop()
+        self.assertTrue(recorder.out.closed)
+        events = shellac.record.load(self.path)
+        self.assertEqual([e['kind'] for e in events],
+                         ["complete", "line", "output", "line", "output"])
+        self.assertIn("staff", events[2]['text'])
+        rl.completion.append_character = "/"
+        self.addCleanup(setattr, rl.completion, 'append_character', " ")
+        result = shellac.record.replay(events, self.new_tool, concurrency=3)
+        self.assertEqual(result['lines']['count'], 6)
+        self.assertEqual(result['completions']['count'], 3)
+        # Completion left readline alone
+        self.assertEqual(rl.completion.append_character, "/")
+
+    def test_replay_too_many_matches(self):
+        too_many = []
+
+        def new_tool():
+            tool = self.new_tool()
+            tool.completion_limit = 1
+            tool.too_many_matches = too_many.append
+            return tool
+
+        events = [{'kind': 'complete', 'buf': 'user ', 'endidx': 5, 't': 0}]
+        result = shellac.record.replay(events, new_tool, concurrency=2)
+        self.assertEqual(result['completions']['count'], 2)
+        self.assertEqual(too_many, [])
+
+    def test_capture_is_per_thread(self):
+        tool = self.new_tool()
+        out = io.StringIO()
+        started = threading.Event()
+        finish = threading.Event()
+
+        def other():
+            with shellac.redirect_stdout(out):
+                started.wait()
+                print("other thread")
+                finish.set()
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        with tool.record(self.path):
+            with tool._capture("group list"):
+                self.assertNotIsInstance(sys.stdout, shellac.record.Tee)
+                print("this thread")
+                started.set()
+                finish.wait()
+        thread.join()
+        self.assertEqual(out.getvalue(), "other thread\n")
+        events = shellac.record.load(self.path)
+        self.assertEqual(events[0]['text'], "this thread\n")
+
+    def test_replay_error(self):
+        def new_tool():
+            tool = self.new_tool()
+            tool.onecmd = lambda line: 1 / 0
+            return tool
+
+        events = [{'kind': 'line', 'line': 'group list', 't': 0}]
+        self.assertRaises(ZeroDivisionError, shellac.record.replay,
+                          events, new_tool, concurrency=2)
+
+
+class AuditTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "audit.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_audit_onecmd(self):
+        tool = UserGroupTool(stdin=io.StringIO(), stdout=io.StringIO())
+        tool.audit(self.path, user="tester")
+        tool.onecmd("group list")
+        tool.onecmd("user remove nosuchuser")
+        tool.audit_log.close()
+        with open(self.path) as log:
+            records = [json.loads(line) for line in log]
+        self.assertEqual([r['line'] for r in records],
+                         ["group list", "user remove nosuchuser"])
+        self.assertEqual(records[1]['result'], False)
+        self.assertEqual(records[0]['user'], "tester")
+
+    def test_rotation(self):
+        writer = shellac.audit.AuditLog(self.path, batch_size=1,
+                                        max_bytes=10, backup_count=2)
+        for i in range(5):
+            writer.log("line %d" % i, 0, 0)
+        writer.close()
+        self.assertTrue(os.path.exists(self.path + ".2"))
+        self.assertFalse(os.path.exists(self.path + ".3"))
+
+
+class SessionTests(TestCase):
+
+    def setUp(self):
+        self.tool = UserGroupTool(stdin=io.StringIO(), stdout=io.StringIO())
+
+    def test_sessions_share_tree(self):
+        first = shellac.Session(self.tool, stdin=io.StringIO("nosuch\n"),
+                                stdout=io.StringIO())
+        second = shellac.Session(self.tool, stdout=io.StringIO())
+        first.cmdloop()
+        second.onecmd("other")
+        self.assertEqual(first.stdout.getvalue(),
+                         "*** Unknown syntax: nosuch\n")
+        self.assertEqual(second.stdout.getvalue(),
+                         "*** Unknown syntax: other\n")
+        self.assertEqual(second.lastcmd, "other")
+        self.assertEqual(self.tool.lastcmd, "")
+        self.assertIs(first.do_user, self.tool.do_user)
+
+    def test_session_binds_wrapped_methods(self):
+        class Tool(shellac.Shellac):
+            @shellac.cached(ttl=60)
+            def do_cached(self, args):
+                self.stdout.write("cached " + args + "\n")
+
+            @shellac.coalesce
+            def do_shared(self, args):
+                self.stdout.write("shared " + args + "\n")
+
+        tool = Tool(stdin=io.StringIO(), stdout=io.StringIO())
+        session = shellac.Session(tool, stdout=io.StringIO())
+        session.onecmd("cached a")
+        session.onecmd("shared b")
+        self.assertEqual(session.stdout.getvalue(), "cached a\nshared b\n")
+        self.assertEqual(tool.stdout.getvalue(), "")
+
+    def test_session_slots(self):
+        session = shellac.Session(self.tool)
+        self.assertRaises(AttributeError, setattr, session, 'extra', 1)
+        self.assertEqual(list(session._complete("group m", 7)), ["member"])
+
+
+class ServerTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "shellac.sock")
+        tool = UserGroupTool(stdin=io.StringIO(), stdout=io.StringIO())
+        self.server = shellac.server.make_server(tool, self.path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_and_complete(self):
+        with shellac.server.Client(self.path) as client:
+            self.assertEqual(client.run("group list"),
+                             "['staff', 'students', 'visitors']\n")
+            self.assertEqual(client.run("nosuch"),
+                             "*** Unknown syntax: nosuch\n")
+            self.assertEqual(client.complete("group m"), ["member"])
+
+    def test_error_and_completion_limit(self):
+        def do_fail(args):
+            print("partial")
+            raise ValueError("bad " + args)
+
+        self.server.shell.do_fail = do_fail
+        self.server.shell.completion_limit = 1
+        with shellac.server.Client(self.path) as client:
+            self.assertEqual(client.run("fail input"),
+                             "partial\n*** ValueError: bad input\n")
+            self.assertEqual(client.complete("group "), ["add"])
+            self.assertEqual(client.run("nosuch"),
+                             "*** Unknown syntax: nosuch\n")
+
+    def test_concurrent_clients(self):
+        outputs = []
+
+        def run():
+            with shellac.server.Client(self.path) as client:
+                outputs.append([client.run("group member list %d" % i)
+                                for i in range(20)])
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expected = ["Group membership not implemented!%d\n" % i
+                    for i in range(20)]
+        self.assertEqual(outputs, [expected] * 4)
+
+
+class TimeoutTests(TestCase):
+
+    class SlowTool(shellac.Shellac):
+
+        @staticmethod
+        @shellac.timeout(0.05)
+        def do_wait(args):
+            while not shellac.cancelled():
+                time.sleep(0.005)
+            return "cancelled"
+
+        @staticmethod
+        def do_sleep(args):
+            time.sleep(float(args))
+            return args
+
+        @staticmethod
+        @shellac.timeout(None)
+        def do_untimed(args):
+            return shellac.current_token()
+
+        @staticmethod
+        @shellac.timeout(1)
+        def do_fail(args):
+            raise ValueError(args)
+
+    def setUp(self):
+        self.tool = self.SlowTool(stdin=io.StringIO(), stdout=io.StringIO())
+
+    def test_decorator_timeout(self):
+        self.assertIsNone(self.tool.onecmd("wait"))
+        self.assertEqual(self.tool.stdout.getvalue(),
+                         "*** Timed out after 0.05s: wait\n")
+
+    def test_global_timeout(self):
+        self.tool.command_timeout = 0.05
+        self.assertEqual(self.tool.onecmd("sleep 0"), "0")
+        self.assertIsNone(self.tool.onecmd("sleep 0.5"))
+        self.assertIsNone(self.tool.onecmd("untimed"))
+
+    def test_exception(self):
+        self.assertRaises(ValueError, self.tool.onecmd, "fail now")
+
+
+class CachedTests(TestCase):
+
+    def setUp(self):
+        self.tool = UserGroupTool(stdin=io.StringIO(), stdout=io.StringIO())
+        self.do_list = UserGroupTool.do_user.do_list
+        self.do_list.invalidate()
+        self.do_list.hits = self.do_list.misses = 0
+        self.out = io.StringIO()
+
+    def run_cmd(self, line):
+        with shellac.redirect_stdout(self.out):
+            self.tool.onecmd(line)
+
+    def test_cached_output(self):
+        self.run_cmd("user list")
+        self.run_cmd("user list")
+        self.assertEqual(self.do_list.misses, 1)
+        first, second = self.out.getvalue().splitlines()
+        self.assertEqual(first, second)
+
+    def test_invalidates(self):
+        self.run_cmd("user list")
+        self.run_cmd("user add yolanda")
+        self.run_cmd("user list")
+        self.run_cmd("user remove yolanda")
+        self.assertEqual(self.do_list.stats()['entries'], 0)
+        self.assertIn("'yolanda'", self.out.getvalue().splitlines()[2])
+
+    def test_cache_command(self):
+        self.run_cmd("user list")
+        self.run_cmd("user list")
+        self.tool.onecmd("cache")
+        self.assertEqual(self.tool.stdout.getvalue(),
+                         "user list: 1 hits, 1 misses (50%), 1 entries\n")
+        self.tool.onecmd("cache clear")
+        self.assertEqual(self.do_list.stats()['entries'], 0)
+
+    def test_cached_method_output(self):
+        class Tool(shellac.Shellac):
+            @shellac.cached()
+            def do_motd(self, args):
+                self.stdout.write("welcome\n")
+                print("printed")
+
+        tool = Tool(stdin=io.StringIO(), stdout=io.StringIO())
+        out = io.StringIO()
+        session = shellac.Session(tool, stdout=io.StringIO())
+        with shellac.redirect_stdout(out):
+            tool.onecmd("motd")
+            session.onecmd("motd")
+        self.assertEqual(Tool.do_motd.misses, 1)
+        self.assertEqual(tool.stdout.getvalue(), "welcome\n")
+        self.assertEqual(session.stdout.getvalue(), "welcome\n")
+        self.assertEqual(out.getvalue(), "printed\nprinted\n")
+
+    def test_ttl_and_maxsize(self):
+        command = shellac.cached(ttl=0, maxsize=2)(lambda args: args)
+        command("a")
+        command("a")
+        self.assertEqual(command.hits, 0)
+        command.ttl = 60
+        for args in "abc":
+            command(args)
+        self.assertEqual(list(command.cache), ["b", "c"])
+
+
+class BatchableTests(TestCase):
+
+    class BulkTool(shellac.Shellac):
+
+        calls = []
+
+        @staticmethod
+        def bulk_add(names):
+            BatchableTests.BulkTool.calls.append(names)
+            return [name.upper() for name in names]
+
+        @staticmethod
+        @shellac.batchable(bulk_add, max_batch=3)
+        def do_add(args):
+            BatchableTests.BulkTool.calls.append(args)
+            return args
+
+        @staticmethod
+        def do_other(args):
+            BatchableTests.BulkTool.calls.append("other")
+
+        def postcmd(self, stop, line):
+            self.results.append((line, stop))
+
+    def setUp(self):
+        self.BulkTool.calls = []
+        self.tool = self.BulkTool(stdin=io.StringIO(), stdout=io.StringIO())
+        self.tool.results = []
+
+    def test_runscript(self):
+        self.tool.runscript(["add a", "add b", "other", "add c", "add d",
+                             "add e", "add f", "add g"])
+        self.assertEqual(self.tool.calls, [["a", "b"], "other",
+                                           ["c", "d", "e"], ["f", "g"]])
+        self.assertEqual(self.tool.results[:2],
+                         [("add a", "A"), ("add b", "B")])
+        self.assertEqual(len(self.tool.results), 8)
+
+    def test_precmd_changes_command(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.tool.record(os.path.join(tmpdir, "session.log"))
+        self.tool.precmd = lambda line: "other x" if line == "add b" else line
+        self.tool.runscript(["add a", "add b", "add c"])
+        self.tool.recorder.close()
+        self.assertEqual(self.tool.calls, [["a"], "other", ["c"]])
+        self.assertEqual([line for line, _ in self.tool.results],
+                         ["add a", "other x", "add c"])
+        events = shellac.record.load(os.path.join(tmpdir, "session.log"))
+        self.assertIn(("output", "add b"),
+                      [(e['kind'], e['line']) for e in events])
+
+    def test_max_delay(self):
+        self.tool.do_add.batch.max_delay = 0.01
+        self.addCleanup(setattr, self.tool.do_add.batch, 'max_delay', 0.5)
+
+        def slow_lines():
+            yield "add a\n"
+            yield "add b\n"
+            time.sleep(0.1)
+            yield "add c\n"
+
+        self.tool.runscript(slow_lines())
+        self.assertEqual(self.tool.calls, [["a", "b"], ["c"]])
+
+    def test_result_count(self):
+        self.tool.do_add.batch.handler = lambda names: ["one"]
+        self.addCleanup(setattr, self.tool.do_add.batch, 'handler',
+                        self.BulkTool.bulk_add)
+        self.assertRaises(ValueError, self.tool.runscript,
+                          ["add a", "add b"])
+
+    def test_timeout_and_recorder(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.tool.record(os.path.join(tmpdir, "session.log"))
+        self.tool.command_timeout = 0.05
+        self.tool.do_add.batch.handler = lambda names: time.sleep(0.5)
+        self.addCleanup(setattr, self.tool.do_add.batch, 'handler',
+                        self.BulkTool.bulk_add)
+        self.tool.runscript(["add a", "add b"])
+        self.tool.recorder.close()
+        self.assertEqual(self.tool.results, [("add a", None),
+                                             ("add b", None)])
+        events = shellac.record.load(os.path.join(tmpdir, "session.log"))
+        self.assertEqual([(e['kind'], e['line']) for e in events],
+                         [("line", "add a"), ("line", "add b"),
+                          ("output", "add b")])
+        self.assertIn("Timed out", events[2]['text'])
+
+    def test_middleware_not_batched(self):
+        seen = []
+
+        def log(call, shell, line, func, args):
+            seen.append(line)
+            return call(shell, line, func, args)
+
+        self.tool.use(log)
+        self.tool.runscript(["add a", "add b"])
+        self.assertEqual(self.tool.calls, ["a", "b"])
+        self.assertEqual(seen, ["add a", "add b"])
+
+    def test_cmdqueue(self):
+        tool = UserGroupTool(stdin=io.StringIO(), stdout=io.StringIO())
+        tool.cmdqueue = ["exit", "user remove yves", "user remove xena",
+                         "user add yves", "user add xena"]
+        out = io.StringIO()
+        with shellac.redirect_stdout(out):
+            tool.cmdloop()
+        self.assertEqual(out.getvalue().splitlines()[0],
+                         "Added users: xena, yves")
+
+
+class GroupTests(TestCase):
+
+    class Site(object):
+        """Commands for a single site."""
+
+        def __init__(self, name):
+            self.name = name
+
+        def do_status(self, args):
+            """Show the status of the site."""
+            return "%s is up" % self.name
+
+    sites = ["site%05d" % i for i in range(100000)]
+
+    @classmethod
+    def list_sites(cls, prefix):
+        start = bisect.bisect_left(cls.sites, prefix)
+        for name in cls.sites[start:]:
+            if not name.startswith(prefix):
+                break
+            yield name
+
+    @classmethod
+    def make_site(cls, name):
+        if name in cls.sites[bisect.bisect_left(cls.sites, name):][:1]:
+            return cls.Site(name)
+
+    def setUp(self):
+        group = shellac.Group(self.list_sites, self.make_site,
+                              doc="Manage sites.")
+
+        class SiteTool(shellac.Shellac):
+            do_site = group
+
+        self.group = group
+        self.tool = SiteTool(stdin=io.StringIO(), stdout=io.StringIO())
+
+    def test_dispatch(self):
+        self.assertEqual(self.tool.onecmd("site site00042 status"),
+                         "site00042 is up")
+        self.tool.onecmd("site nosuch status")
+        self.assertEqual(self.tool.stdout.getvalue(),
+                         "*** Unknown syntax: site nosuch status\n")
+        self.assertEqual(list(self.group._children), ["site00042"])
+
+    def test_complete(self):
+        self.assertEqual(list(self.tool._complete("site site0004", 13)),
+                         ["site%05d" % i for i in range(40, 50)])
+        self.assertEqual(list(self.tool._complete("site site00042 st", 17)),
+                         ["status"])
+        self.assertEqual(sorted(self.tool._complete("help site site0000", 18)),
+                         ["site%05d" % i for i in range(10)])
+        self.assertEqual(list(self.group._children), ["site00042"])
+
+    def test_help(self):
+        self.tool.onecmd("help site")
+        self.tool.onecmd("help site site00007 status")
+        self.assertEqual(self.tool.stdout.getvalue(),
+                         "Manage sites.\nShow the status of the site.\n")
+
+    def test_help_without_doc(self):
+        class SiteTool(shellac.Shellac):
+            do_site = shellac.Group(self.list_sites, self.make_site)
+
+        tool = SiteTool(stdin=io.StringIO(), stdout=io.StringIO())
+        tool.onecmd("help site")
+        self.assertEqual(tool.stdout.getvalue(), "*** No help for site\n")
+
+
+class HistoryTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "history")
+        with open(self.path, "w") as hist:
+            hist.write("user add alice\ngroup list\nuser list\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_search(self):
+        history = shellac.history.History(self.path)
+        history.load()
+        history.append("group add staff")
+        self.assertEqual(list(history.search("group", prefix=True)),
+                         [(3, "group add staff"), (1, "group list")])
+        self.assertEqual(list(history.search("list", limit=1)),
+                         [(2, "user list")])
+        history.close()
+        with open(self.path) as hist:
+            self.assertEqual(hist.read().splitlines()[-1], "group add staff")
+
+    def test_compaction(self):
+        history = shellac.history.History(self.path, maxlen=2)
+        history.load()
+        with open(self.path) as hist:
+            self.assertEqual(hist.read(), "group list\nuser list\n")
+        history.append("a")
+        history.append("b")
+        # Compaction is queued behind the writes, so append() doesn't wait
+        history.append("c")
+        history.close()
+        with open(self.path) as hist:
+            self.assertEqual(hist.read(), "a\nb\nc\n")
+        self.assertEqual(len(history), 3)
+        self.assertEqual(list(history.search("")),
+                         [(2, "c"), (1, "b"), (0, "a")])
+
+    def test_cmdloop_and_history_command(self):
+        tool = UserGroupTool(stdin=io.StringIO(), stdout=io.StringIO())
+        tool.history_file = self.path
+        lines = iter(["user remove nosuchuser", "history user"])
+
+        def inp(prompt):
+            try:
+                return next(lines)
+            except StopIteration:
+                raise EOFError()
+
+        tool.inp = inp
+        with shellac.redirect_stdout(io.StringIO()):
+            tool.cmdloop()
+        self.assertEqual(tool.stdout.getvalue(),
+                         "     1  user add alice\n"
+                         "     3  user list\n"
+                         "     4  user remove nosuchuser\n"
+                         "\n")
+        with open(self.path) as hist:
+            self.assertEqual(hist.read().splitlines()[-2:],
+                             ["user remove nosuchuser", "history user"])
+
+
+class MappedCandidatesTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "accounts")
+        names = ["acc%04d" % i for i in range(999, -1, -1)]
+        shellac.mapped.build_sorted(names + ["b\u00e9", "", "acc0001"],
+                                    self.path, chunk_size=300)
+        self.candidates = shellac.mapped.MappedCandidates(self.path)
+
+    def tearDown(self):
+        self.candidates.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_build_sorted(self):
+        with open(self.path, encoding="utf-8") as accounts:
+            lines = accounts.read().splitlines()
+        self.assertEqual(lines, ["acc%04d" % i for i in range(1000)] +
+                         ["b\u00e9"])
+        self.assertEqual(os.listdir(self.tmpdir), ["accounts"])
+
+    def test_matches(self):
+        self.assertEqual(list(self.candidates("acc012")),
+                         ["acc%04d" % i for i in range(120, 130)])
+        self.assertEqual(list(self.candidates("acc0999")), ["acc0999"])
+        self.assertEqual(list(self.candidates("b")), ["b\u00e9"])
+        self.assertEqual(list(self.candidates("c")), [])
+        self.assertEqual(len(list(self.candidates(""))), 1001)
+
+    def test_completer(self):
+        candidates = self.candidates
+
+        class AccountTool(shellac.Shellac):
+            @staticmethod
+            @shellac.completer(candidates)
+            def do_show(args):
+                pass
+
+        tool = AccountTool(stdin=io.StringIO(), stdout=io.StringIO())
+        self.assertEqual(list(tool._complete("show acc000", 11)),
+                         ["acc%04d" % i for i in range(10)])
+
+
+class WarmTests(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        calls = self.calls
+
+        @shellac.warmable
+        def hosts(token):
+            calls.append(token)
+            return shellac.complete_list(["db1", "db2", "web1"], token)
+
+        def slow(token):
+            calls.append('slow')
+            return []
+
+        class Tool(shellac.Shellac):
+            class do_host(object):
+                @staticmethod
+                @shellac.completer(hosts)
+                @shellac.completer(slow)
+                def do_ping(args):
+                    pass
+
+                @staticmethod
+                def do_status(args):
+                    pass
+
+        self.Tool = Tool
+
+    def test_members_cached(self):
+        self.assertEqual(list(shellac.members(self.Tool.do_host)),
+                         ["ping", "status"])
+        self.assertIn(self.Tool.do_host, shellac._member_names)
+        tool = self.Tool(stdin=io.StringIO(), stdout=io.StringIO())
+        tool.do_extra = lambda args: None
+        self.assertEqual(list(shellac.members(tool, start='e')),
+                         ["exit", "extra"])
+        session = shellac.Session(tool)
+        self.assertEqual(list(shellac.members(session, start='h')),
+                         ["help", "history", "host"])
+
+    def test_members_added_at_runtime(self):
+        tool = self.Tool(stdin=io.StringIO(), stdout=io.StringIO())
+        self.assertEqual(tool.complete_line("host "), ["ping", "status"])
+        self.Tool.do_host.do_add = staticmethod(lambda args: None)
+        self.assertEqual(tool.complete_line("host "),
+                         ["add", "ping", "status"])
+        del self.Tool.do_host.do_status
+        self.assertEqual(tool.complete_line("host "), ["add", "ping"])
+
+    def test_warm(self):
+        tool = self.Tool(stdin=io.StringIO(), stdout=io.StringIO())
+        rl.completion.append_character = "/"
+        self.assertTrue(tool.warm())
+        self.assertEqual(self.calls, [''])
+        # complete_list() didn't touch readline
+        self.assertEqual(rl.completion.append_character, "/")
+        rl.completion.append_character = " "
+        self.assertIn(self.Tool, shellac._member_names)
+        self.assertIn(self.Tool.do_host, shellac._member_names)
+
+    def test_warm_budget(self):
+        tool = self.Tool(stdin=io.StringIO(), stdout=io.StringIO())
+        self.assertFalse(tool.warm(0))
+        self.assertEqual(self.calls, [])
+
+    def test_cmdloop_warmup(self):
+        tool = self.Tool(stdin=io.StringIO(), stdout=io.StringIO())
+        tool.warmup = 5
+        tool.inp = lambda prompt: 'exit'
+        tool.cmdloop()
+        deadline = time.monotonic() + 5
+        while not self.calls and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.calls, [''])
+
+
+class ScheduleTests(TestCase):
+
+    def setUp(self):
+        self.times = []
+        times = self.times
+
+        class Tool(shellac.Shellac):
+            def do_tick(self, args):
+                times.append(time.monotonic())
+                self.stdout.write("tick {0}\n".format(args))
+
+        self.out = io.StringIO()
+        self.tool = Tool(stdin=io.StringIO(), stdout=self.out)
+
+    def test_repeat(self):
+        self.tool.onecmd("repeat 3 tick a  b")
+        self.assertEqual(self.out.getvalue(), "tick a  b\n" * 3)
+
+    def test_repeat_interval(self):
+        self.tool.onecmd("repeat 3 -n 0.05 tick")
+        self.assertEqual(len(self.times), 3)
+        self.assertGreaterEqual(self.times[2] - self.times[0], 0.09)
+
+    def test_watch(self):
+        self.tool.onecmd("watch -n 0.01 -c 2 tick")
+        lines = self.out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith("Every 0.01s: tick"))
+        self.assertEqual(lines.count("tick "), 2)
+        self.assertNotIn("\033", self.out.getvalue())
+
+    def test_usage(self):
+        for line in ("watch", "watch -n x tick", "watch -n 0 tick",
+                     "repeat tick", "repeat 2", "repeat 2 -n"):
+            self.tool.onecmd(line)
+        self.assertEqual(self.out.getvalue().count("*** Usage"), 6)
+        self.assertEqual(self.times, [])
+
+    def test_interrupt(self):
+        def tick(args):
+            if len(self.times) == 2:
+                raise KeyboardInterrupt()
+            self.times.append(args)
+
+        self.tool.do_tick = tick
+        self.assertRaises(KeyboardInterrupt, self.tool.onecmd,
+                          "watch -n 0.01 tick")
+        self.assertEqual(len(self.times), 2)
+
+
+class ArgumentsTests(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        calls = self.calls
+
+        def hosts(token):
+            return shellac.complete_list(["db1", "db2", "web1"], token)
+
+        class Tool(shellac.Shellac):
+            class do_host(object):
+                @staticmethod
+                @shellac.arguments(
+                    shellac.Argument('name', choices=hosts),
+                    shellac.Argument('--count', '-n', type=int, default=1,
+                                     help="Number of pings"),
+                    shellac.Argument('--mode', choices=['fast', 'slow'],
+                                     default='fast'),
+                    shellac.Argument('--quiet', '-q', type=bool,
+                                     help="No output"),
+                    shellac.Argument('tags', many=True))
+                def do_ping(name, count, mode, quiet, tags):
+                    """Ping a host."""
+                    calls.append((name, count, mode, quiet, tags))
+
+            @shellac.arguments(shellac.Argument('size', type=float,
+                                                default=1.5))
+            def do_resize(self, size):
+                calls.append(size)
+
+        self.out = io.StringIO()
+        self.tool = Tool(stdin=io.StringIO(), stdout=self.out)
+
+    def test_parse(self):
+        self.tool.onecmd("host ping db1")
+        self.tool.onecmd("host ping -n 3 --mode=slow db2 -q a 'b c'")
+        self.tool.onecmd("host ping web1 -- -x")
+        self.tool.onecmd("resize")
+        self.tool.onecmd("resize -2")
+        self.assertEqual(self.calls,
+                         [("db1", 1, "fast", False, []),
+                          ("db2", 3, "slow", True, ["a", "b c"]),
+                          ("web1", 1, "fast", False, ["-x"]),
+                          1.5, -2.0])
+        self.assertEqual(self.out.getvalue(), "")
+
+    def test_errors(self):
+        for line, message in (("host ping", "missing NAME"),
+                              ("host ping db1 -n x",
+                               "invalid int value for --count: 'x'"),
+                              ("host ping db1 --mode=medium",
+                               "invalid choice for --mode: 'medium'"),
+                              ("host ping db1 --count", "--count needs a value"),
+                              ("host ping db1 --bogus", "unknown option --bogus"),
+                              ("resize 1 2", "unexpected argument 2")):
+            self.out.seek(0)
+            self.out.truncate()
+            self.tool.onecmd(line)
+            self.assertEqual(self.out.getvalue().splitlines()[0],
+                             "*** " + message)
+        self.assertEqual(self.out.getvalue().splitlines()[1],
+                         "Usage: resize [SIZE]")
+        self.assertEqual(self.calls, [])
+
+    def test_error_fields(self):
+        schema = self.tool.do_host.do_ping.schema
+        try:
+            schema.parse("db1 -n x")
+        except shellac.ArgumentError as exc:
+            self.assertIsInstance(exc, ValueError)
+            self.assertEqual((exc.argument, exc.value), ("count", "x"))
+            self.assertEqual(exc.usage, "[--count COUNT] [--mode MODE] "
+                             "[--quiet] NAME [TAGS...]")
+        else:
+            self.fail("ArgumentError not raised")
+
+    def test_help(self):
+        self.tool.onecmd("help host ping")
+        self.assertEqual(self.out.getvalue(),
+                         "Ping a host.\n\n"
+                         "Arguments:\n"
+                         "  --count, -n COUNT  Number of pings\n"
+                         "  --quiet, -q        No output\n")
+
+    def test_complete(self):
+        complete = lambda line: sorted(self.tool._complete(line, len(line)))
+        self.assertEqual(complete("host ping d"), ["db1", "db2"])
+        self.assertEqual(complete("host ping --m"), ["--mode"])
+        self.assertEqual(complete("host ping --mode "), ["fast", "slow"])
+        self.assertEqual(complete("host ping -q -n 2 w"), ["web1"])
+        self.assertEqual(complete("host ping db1 t"), [])
+
+
+class ParallelTool(shellac.Shellac):
+
+    def do_square(self, args):
+        self.stdout.write("{0}\n".format(int(args) ** 2))
+
+    def do_pid(self, args):
+        print(os.getpid())
+
+    @shellac.serial
+    def do_serial_pid(self, args):
+        print(os.getpid())
+
+    def do_fail(self, args):
+        raise RuntimeError("failed")
+
+
+class ParallelTests(TestCase):
+
+    def run_script(self, lines, **options):
+        out = io.StringIO()
+        stop = shellac.parallel.run(
+            lambda: ParallelTool(stdin=io.StringIO()), lines,
+            stdout=out, **options)
+        return stop, out.getvalue()
+
+    def test_order(self):
+        lines = ["square %d\n" % i for i in range(200)]
+        stop, output = self.run_script(lines, processes=3, window=7,
+                                       chunk_size=2)
+        self.assertIsNone(stop)
+        self.assertEqual(output.split(), [str(i * i) for i in range(200)])
+
+    def test_serial(self):
+        stop, output = self.run_script(["pid", "serial_pid", "square 3"],
+                                       processes=2)
+        pids = output.split()
+        self.assertNotEqual(pids[0], str(os.getpid()))
+        self.assertEqual(pids[1:], [str(os.getpid()), "9"])
+
+    def test_error(self):
+        lines = ["square 1", "fail", "square 2"]
+        with self.assertRaises(shellac.parallel.ScriptError) as caught:
+            self.run_script(lines, processes=2, chunk_size=1)
+        self.assertEqual(caught.exception.index, 1)
+        self.assertIn("RuntimeError: failed", caught.exception.traceback)
+
+    def test_stop(self):
+        stop, output = self.run_script(["square 1", "exit", "square 2"],
+                                       processes=1)
+        self.assertTrue(stop)
+        self.assertEqual(output, "1\n")
+
+    def test_main_spawn(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "script")
+        with open(path, "w") as script:
+            script.write("square 2\nsquare 3\n")
+        out = io.StringIO()
+        with shellac.redirect_stdout(out):
+            shellac.parallel.main([path, "shellac.tests:ParallelTool",
+                                   "--processes", "1",
+                                   "--start-method", "spawn"])
+        self.assertEqual(out.getvalue(), "4\n9\n")
+
+    def test_bench(self):
+        tree = shellac.bench.make_tree(depth=1, fanout=2)
+        scaling = shellac.bench.script_scaling(tree, processes=2, lines=20,
+                                               spin=10)
+        self.assertEqual(sorted(scaling), ["parallel", "serial"])
+        self.assertGreater(scaling['parallel']['usec'], 0)
+
+
+RELOAD_V1 = '''
+import shellac
+
+class Users(object):
+    @staticmethod
+    def do_list(args):
+        return "list1"
+
+def ping(args):
+    return "pong1"
+
+class Shell(shellac.Shellac):
+    do_user = Users
+    do_ping = staticmethod(ping)
+
+    def do_hello(self, args):
+        return "hello1"
+'''
+
+RELOAD_V2 = '''
+import shellac
+
+class Users(object):
+    @staticmethod
+    def do_list(args):
+        return "list2"
+
+    @staticmethod
+    def do_add(args):
+        return "add2"
+
+def ping(args):
+    return "pong2"
+
+class Shell(shellac.Shellac):
+    do_user = Users
+    do_ping = staticmethod(ping)
+
+    def do_bye(self, args):
+        return "bye2"
+'''
+
+
+class ReloadTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "reloadcmds.py")
+        self.write(RELOAD_V1)
+        sys.path.insert(0, self.tmpdir)
+        import reloadcmds
+        self.module = reloadcmds
+        self.out = io.StringIO()
+
+    def tearDown(self):
+        sys.path.remove(self.tmpdir)
+        sys.modules.pop("reloadcmds", None)
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, source, offset=0):
+        with open(self.path, "w") as module:
+            module.write(source)
+        mtime = time.time() + offset
+        os.utime(self.path, (mtime, mtime))
+
+    def test_reload_subclass(self):
+        module = self.module
+
+        class Tool(module.Shell):
+            @staticmethod
+            def do_local(args):
+                return "local"
+
+        tool = Tool(stdin=io.StringIO(), stdout=self.out)
+        self.assertEqual(list(shellac.members(tool.do_user)), ["list"])
+        self.assertIn(module.Users, shellac._member_names)
+        tool.onecmd("reload")
+        self.assertEqual(self.out.getvalue(), "Nothing to reload\n")
+
+        list(shellac.members(UserGroupTool.do_user))
+        self.write(RELOAD_V2, 10)
+        tool.onecmd("reload")
+        self.assertIn(UserGroupTool.do_user, shellac._member_names)
+        self.assertEqual(self.out.getvalue().splitlines()[-1],
+                         "Reloaded reloadcmds")
+        self.assertIn("do_bye", shellac._member_names[Tool][1])
+        self.assertNotIn(module.Users, shellac._member_names)
+        self.assertEqual(tool.onecmd("user list"), "list2")
+        self.assertEqual(tool.onecmd("user add"), "add2")
+        self.assertEqual(tool.onecmd("ping"), "pong2")
+        self.assertEqual(tool.onecmd("bye"), "bye2")
+        self.assertEqual(tool.onecmd("local"), "local")
+        self.assertFalse(hasattr(tool, "do_hello"))
+        self.assertEqual(list(tool._complete("user ", 5)), ["add", "list"])
+
+    def test_unknown_and_failed(self):
+        tool = self.module.Shell(stdin=io.StringIO(), stdout=self.out)
+        tool.onecmd("reload nosuchmodule")
+        self.write("def broken(:\n", 10)
+        tool.onecmd("reload")
+        lines = self.out.getvalue().splitlines()
+        self.assertEqual(lines[0], "*** Not a command module: nosuchmodule")
+        self.assertTrue(lines[1].startswith(
+            "*** Reload of reloadcmds failed: SyntaxError"))
+        self.assertEqual(tool.onecmd("hello"), "hello1")
+
+
+class AliasTests(TestCase):
+
+    def setUp(self):
+        self.lines = []
+        lines = self.lines
+
+        class Tool(shellac.Shellac):
+            class do_user(object):
+                """Manage users."""
+
+                @staticmethod
+                def do_add(args):
+                    """Add a user."""
+                    lines.append("user add " + args)
+
+                @staticmethod
+                def do_list(args):
+                    lines.append("user list " + args)
+
+            def do_echo(self, args):
+                lines.append("echo " + args)
+
+        self.out = io.StringIO()
+        self.tool = Tool(stdin=io.StringIO(), stdout=self.out)
+
+    def test_alias(self):
+        self.tool.onecmd("alias ua user add")
+        self.tool.onecmd("ua bob")
+        self.tool.onecmd("ua")
+        self.assertEqual(self.lines, ["user add bob", "user add "])
+        self.tool.onecmd("unalias ua")
+        self.tool.onecmd("ua bob")
+        self.assertEqual(self.out.getvalue(), "*** Unknown syntax: ua bob\n")
+
+    def test_macro(self):
+        self.tool.alias("ul", "user list")
+        self.tool.alias("setup", "user add $1; ul $2; echo $*")
+        self.tool.alias("echo", "echo hi;echo")
+        self.tool.runscript(["setup a b", "echo done", "\\echo raw"])
+        self.assertEqual(self.lines, ["user add a", "user list b",
+                                      "echo hi", "echo a b",
+                                      "echo hi", "echo done", "echo raw"])
+
+    def test_macro_onecmd(self):
+        self.tool.alias("two", "echo 1; echo 2; echo 3")
+        self.tool.alias("stop", "echo a; exit; echo b")
+        self.tool.cmdqueue = ["echo later"]
+        self.assertIsNone(self.tool.onecmd("two"))
+        self.assertEqual(self.lines, ["echo 1", "echo 2", "echo 3"])
+        self.assertEqual(self.tool.cmdqueue, ["echo later"])
+        self.assertTrue(self.tool.onecmd("stop"))
+        self.assertEqual(self.lines[3:], ["echo a"])
+
+    def test_show_and_load(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "aliases")
+        with open(path, "w") as aliases:
+            aliases.write("# shortcuts\nua user add\n\nboth ua x; ua y\n")
+        self.tool.load_aliases(path)
+        self.tool.onecmd("alias")
+        self.tool.onecmd("alias ua")
+        self.tool.onecmd("alias nosuch")
+        self.assertEqual(self.out.getvalue(),
+                         "both = ua x; ua y\nua = user add\nua = user add\n"
+                         "*** No alias nosuch\n")
+        self.tool.onecmd("both")
+        self.assertEqual(self.lines, ["user add x", "user add y"])
+
+    def test_complete_and_help(self):
+        self.tool.alias("ua", "user add")
+        self.tool.alias("ul", "user list")
+        self.tool.alias("m", "echo a; echo b")
+        complete = lambda line: list(self.tool._complete(line, len(line)))
+        self.assertEqual(complete("u"), ["ua", "ul", "unalias", "user"])
+        self.assertEqual(complete("help u"), ["ua", "ul", "unalias", "user"])
+        self.assertEqual(complete("e"), ["echo", "exit"])
+        self.tool.onecmd("help ua")
+        self.assertEqual(self.out.getvalue(),
+                         "ua is an alias for 'user add'\n\nAdd a user.\n")
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.tool.alias, "a b", "echo")
+        self.tool.onecmd("alias x ;")
+        self.assertEqual(self.out.getvalue(), "*** empty alias: x\n")
+
+
+class FuzzyTests(TestCase):
+
+    def setUp(self):
+        self.fetched = 0
+        self.hosts = ["db-primary", "db-replica", "web-frontend"]
+
+        def hosts(token):
+            self.fetched += 1
+            return shellac.complete_list(self.hosts, token)
+
+        class Tool(shellac.Shellac):
+            class do_group(object):
+                class do_member(object):
+                    @staticmethod
+                    def do_add(args):
+                        pass
+
+                    @staticmethod
+                    def do_remove(args):
+                        pass
+
+                @staticmethod
+                def do_migrate(args):
+                    pass
+
+            @staticmethod
+            @shellac.completer(hosts)
+            def do_ping(args):
+                pass
+
+            @staticmethod
+            def do_garbage_map(args):
+                pass
+
+        self.tool = Tool(stdin=io.StringIO(), stdout=io.StringIO())
+        self.tool.fuzzy = True
+
+    def complete(self, line):
+        return list(self.tool._complete(line, len(line)))
+
+    def test_index(self):
+        index = shellac.fuzzy.FuzzyIndex(["group_add", "grep", "gap",
+                                          "signup", "progress"])
+        self.assertEqual(index.search("gp"), ["gap", "grep", "signup",
+                                              "group_add"])
+        self.assertEqual(index.search("ga"), ["gap", "group_add"])
+        self.assertEqual(index.search("gp", limit=2), ["gap", "grep"])
+        self.assertEqual(index.search("xyz"), [])
+        self.assertEqual(index.search("GA"), ["gap", "group_add"])
+
+    def test_levels(self):
+        self.assertEqual(self.complete("mbr"), [])
+        self.assertEqual(self.complete("group mbr"), ["member"])
+        self.assertEqual(self.complete("group member rm"), ["remove"])
+        self.assertEqual(self.complete("group m"), ["member", "migrate"])
+
+    def test_abbreviation(self):
+        self.assertEqual(self.complete("gma"),
+                         ["group member add", "garbage_map"])
+        self.assertEqual(self.complete("gmr"), ["group member remove"])
+
+    def test_recency(self):
+        self.tool.onecmd("group migrate")
+        self.assertEqual(self.complete("group m"), ["migrate", "member"])
+        self.tool.onecmd("group member remove")
+        self.assertEqual(self.complete("gm"),
+                         ["group member", "group migrate", "garbage_map"])
+
+    def test_candidates(self):
+        self.assertEqual(self.complete("ping rep"), ["db-replica"])
+        self.assertEqual(self.complete("ping dp"),
+                         ["db-primary", "db-replica"])
+        self.assertEqual(self.complete("ping wf"), ["web-frontend"])
+
+    def test_new_candidates(self):
+        self.assertEqual(self.complete("ping wf"), ["web-frontend"])
+        self.hosts.append("zed")
+        # Not in the index yet, so completed as without fuzzy
+        self.assertEqual(self.complete("ping z"), ["zed"])
+        self.assertEqual(self.complete("ping zd"), [])
+        self.tool.fuzzy_ttl = 0
+        self.assertEqual(self.complete("ping zd"), ["zed"])
+
+    def test_sessions_of_different_shells(self):
+        class Alpha(shellac.Shellac):
+            @staticmethod
+            def do_xylophone(args):
+                pass
+
+        class Beta(shellac.Shellac):
+            @staticmethod
+            def do_quokka(args):
+                pass
+
+        sessions = []
+        for cls in (Alpha, Beta):
+            shell = cls(stdin=io.StringIO(), stdout=io.StringIO())
+            shell.fuzzy = True
+            sessions.append(shellac.Session(shell))
+        alpha, beta = sessions
+        self.assertEqual(list(alpha._complete("xyl", 3)), ["xylophone"])
+        self.assertEqual(list(beta._complete("quo", 3)), ["quokka"])
+        self.assertEqual(list(beta._complete("xyl", 3)), [])
+
+    def test_disabled(self):
+        self.tool.fuzzy = False
+        self.assertEqual(list(self.complete("group mbr")), [])
+
+    def test_large_index(self):
+        names = ["name%06d" % i for i in range(100000)]
+        index = shellac.fuzzy.FuzzyIndex(names)
+        start = time.perf_counter()
+        self.assertEqual(index.search("n99999", limit=10)[:1], ["name099999"])
+        self.assertLess(time.perf_counter() - start, 2)
+
+
+class MergeCompletionsTests(TestCase):
+
+    def setUp(self):
+        self.read = []
+        read = self.read
+
+        def staff(token):
+            return [name for name in ["dave", "alice", "carol"]
+                    if name.startswith(token)]
+
+        def students(token):
+            return (name for name in ["bob", "carol", "alice", "ann"]
+                    if name.startswith(token))
+
+        def numbered(token):
+            for i in itertools.count():
+                read.append(i)
+                yield "%s%06d" % (token, i)
+        numbered.sorted = True
+
+        def endless(token):
+            for i in itertools.count():
+                read.append(i)
+                yield "%s%06d" % (token, i)
+
+        class Tool(shellac.Shellac):
+            @staticmethod
+            @shellac.completer(staff)
+            @shellac.completer(students)
+            def do_mail(args):
+                pass
+
+            @staticmethod
+            @shellac.completer(numbered)
+            @shellac.completer(staff)
+            def do_ticket(args):
+                pass
+
+            @staticmethod
+            @shellac.completer(endless)
+            def do_count(args):
+                pass
+
+        self.out = io.StringIO()
+        self.tool = Tool(stdin=io.StringIO(), stdout=self.out)
+
+    def complete(self, line):
+        return list(self.tool._complete(line, len(line)))
+
+    def test_merge(self):
+        self.assertEqual(self.complete("mail "),
+                         ["alice", "ann", "bob", "carol", "dave"])
+        self.assertEqual(self.complete("mail a"), ["alice", "ann"])
+
+    def test_limit(self):
+        self.tool.completion_limit = 3
+        self.assertEqual(self.complete("mail a"), ["alice", "ann"])
+        self.assertEqual(self.complete("mail "), [])
+        self.assertEqual(self.out.getvalue(),
+                         "\n*** too many matches (3+)\n")
+        self.assertEqual(self.complete("ticket x"), [])
+        self.assertLessEqual(len(self.read), 5)
+
+    def test_single_completer_lazy(self):
+        self.tool.completion_limit = 1000
+        self.assertEqual(self.complete("count x"), [])
+        self.assertEqual(len(self.read), 1001)
+
+    def test_no_limit(self):
+        self.tool.completion_limit = None
+        self.assertEqual(len(self.complete("mail ")), 5)
+
+    def test_session(self):
+        self.tool.completion_limit = 2
+        out = io.StringIO()
+        session = shellac.Session(self.tool, stdout=out)
+        self.assertEqual(list(session._complete("mail ", 5)), [])
+        self.assertEqual(out.getvalue(), "*** too many matches (2+)\n")
+
+
+class TTYStringIO(io.StringIO):
+
+    def isatty(self):
+        return True
+
+
+class PagerTests(TestCase):
+
+    def setUp(self):
+        self.produced = []
+        self.closed = []
+        produced, closed = self.produced, self.closed
+
+        class Tool(shellac.Shellac):
+            @staticmethod
+            def do_numbers(args):
+                try:
+                    for i in range(int(args)):
+                        produced.append(i)
+                        yield "line %d" % i
+                finally:
+                    closed.append(True)
+
+            def do_print(self, args):
+                for i in range(int(args)):
+                    produced.append(i)
+                    print("printed %d" % i)
+
+        self.Tool = Tool
+
+    def new_tool(self, answers, lines, out=None):
+        out = TTYStringIO() if out is None else out
+        tool = self.Tool(stdin=io.StringIO(answers), stdout=out)
+        tool.pager = lines
+        return tool
+
+    def test_pages(self):
+        tool = self.new_tool("\n\n", 5)
+        self.assertIsNone(tool.onecmd("numbers 12"))
+        output = tool.stdout.getvalue()
+        self.assertEqual(output.count(shellac.pager.Pager.prompt), 2)
+        self.assertIn("line 11\n", output)
+        self.assertEqual(self.closed, [True])
+
+    def test_quit_stops_producer(self):
+        tool = self.new_tool("q\n", 5)
+        tool.onecmd("numbers 1000000")
+        self.assertEqual(len(self.produced), 6)
+        self.assertEqual(self.closed, [True])
+        self.assertNotIn("line 5", tool.stdout.getvalue())
+
+    def test_print_quit(self):
+        tool = self.new_tool("", 3)
+        tool.onecmd("print 100")
+        self.assertEqual(len(self.produced), 4)
+        self.assertIs(tool.stdout.__class__, TTYStringIO)
+
+    def test_search(self):
+        tool = self.new_tool("/line 1\n/nothing\nq\n", 11)
+        tool.onecmd("numbers 100")
+        output = tool.stdout.getvalue()
+        self.assertIn("     2  line 1\n", output)
+        self.assertIn("Pattern not found: nothing\n", output)
+
+    def test_not_a_terminal(self):
+        tool = self.new_tool("", 5, io.StringIO())
+        tool.onecmd("numbers 100")
+        self.assertEqual(len(tool.stdout.getvalue().splitlines()), 100)
+
+
+class CoalesceTests(TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.backend = []
+        release, backend = self.release, self.backend
+
+        class Tool(shellac.Shellac):
+            @staticmethod
+            @shellac.coalesce
+            def do_status(args):
+                backend.append(args)
+                release.wait(5)
+                if args == "broken":
+                    raise RuntimeError("backend down")
+                print("status of " + args)
+                return len(backend)
+
+        self.Tool = Tool
+        self.tool = Tool(stdin=io.StringIO(), stdout=io.StringIO())
+        self.command = Tool.do_status
+
+    def run_concurrently(self, lines):
+        results = [None] * len(lines)
+
+        def run(i):
+            out = io.StringIO()
+            session = shellac.Session(self.tool, stdout=out)
+            with shellac.redirect_stdout(out):
+                try:
+                    results[i] = (session.onecmd(lines[i]), out.getvalue())
+                except RuntimeError as exc:
+                    results[i] = (exc, out.getvalue())
+
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(len(lines))]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while self.command.calls + self.command.saved < len(lines) and \
+                time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_shared(self):
+        results = self.run_concurrently(["status web"] * 5 + ["status db"])
+        self.assertEqual(sorted(self.backend), ["db", "web"])
+        web = set(results[:5])
+        self.assertEqual(len(web), 1)
+        self.assertEqual(web.pop()[1], "status of web\n")
+        self.assertEqual(results[5][1], "status of db\n")
+        self.assertEqual(self.command.stats(),
+                         {'calls': 2, 'saved': 4, 'in_flight': 0})
+        self.tool.onecmd("cache")
+        self.assertEqual(self.tool.stdout.getvalue(),
+                         "status: 2 calls, 4 saved (67%), 0 running\n")
+
+    def test_exception(self):
+        results = self.run_concurrently(["status broken"] * 3)
+        self.assertEqual(self.backend, ["broken"])
+        errors = [result[0] for result in results]
+        self.assertEqual(len(set(map(id, errors))), 3)
+        for error in errors:
+            self.assertIsInstance(error, RuntimeError)
+            self.assertEqual(str(error), "backend down")
+
+    def test_sequential(self):
+        self.release.set()
+        out = io.StringIO()
+        with shellac.redirect_stdout(out):
+            self.assertEqual(self.tool.onecmd("status web"), 1)
+            self.assertEqual(self.tool.onecmd("status web"), 2)
+        self.assertEqual(out.getvalue(), "status of web\n" * 2)
+        self.assertEqual(self.command.saved, 0)
+
+
+class Deny(shellac.Middleware):
+
+    def __init__(self, command, log):
+        self.command = command
+        self.log = log
+
+    def applies(self, path, func):
+        self.log.append(('applies', path))
+        return path[0] == self.command
+
+    def __call__(self, call, shell, line, func, args):
+        shell.stdout.write("*** Permission denied: {0}\n".format(line))
+
+
+class MiddlewareTool(shellac.Shellac):
+
+    class do_user(object):
+        def do_add(self, args):
+            sys.stdout.write("user add: {0}\n".format(args))
+
+    class do_group(object):
+        @staticmethod
+        def do_add(args):
+            sys.stdout.write("group add: {0}\n".format(args))
+
+
+class MiddlewareTests(TestCase):
+
+    def setUp(self):
+        self.tool = MiddlewareTool(stdin=io.StringIO(), stdout=io.StringIO())
+        self.log = []
+        redirect = shellac.redirect_stdout(self.tool.stdout)
+        redirect.__enter__()
+        self.addCleanup(redirect.__exit__, None, None, None)
+
+    def test_order(self):
+        log = self.log
+
+        def outer(call, shell, line, func, args):
+            log.append('outer')
+            return call(shell, line, func, args.upper())
+
+        def inner(call, shell, line, func, args):
+            log.append('inner ' + args)
+            return call(shell, line, func, args)
+
+        self.tool.use(outer)
+        self.tool.use(inner)
+        self.tool.onecmd("user add alice")
+        self.assertEqual(log, ['outer', 'inner ALICE'])
+        self.assertIn("user add: ALICE", self.tool.stdout.getvalue())
+
+    def test_applies(self):
+        self.tool.use(Deny('group', self.log))
+        self.tool.onecmd("group add staff")
+        self.tool.onecmd("group add staff")
+        self.tool.onecmd("user add alice")
+        self.assertEqual(self.tool.stdout.getvalue(),
+                         "*** Permission denied: group add staff\n" * 2 +
+                         "user add: alice\n")
+        # Each chain is compiled once
+        self.assertEqual(self.log, [('applies', ['group', 'add']),
+                                    ('applies', ['user', 'add'])])
+
+    def test_use_recompiles(self):
+        self.tool.onecmd("group add staff")
+        self.tool.use(Deny('group', self.log))
+        self.tool.onecmd("group add staff")
+        self.assertEqual(self.tool.stdout.getvalue(),
+                         "group add: staff\n"
+                         "*** Permission denied: group add staff\n")
+
+    def test_session(self):
+        self.tool.use(Deny('user', self.log))
+        out = io.StringIO()
+        shellac.Session(self.tool, stdout=out).onecmd("user add alice")
+        self.assertEqual(out.getvalue(),
+                         "*** Permission denied: user add alice\n")
+
+
+class CompleteLineTool(shellac.Shellac):
+
+    class do_user(object):
+        created = 0
+
+        def __init__(self):
+            type(self).created += 1
+
+        @staticmethod
+        def names(token):
+            return shellac.complete_list(["albert", "alice", "bob"], token,
+                                         append_character="!")
+
+        @staticmethod
+        @shellac.completer(names)
+        def do_add(args):
+            pass
+
+        @staticmethod
+        def do_list(args):
+            pass
+
+
+class CompleteLineTests(TestCase):
+
+    def setUp(self):
+        self.tool = CompleteLineTool(stdin=io.StringIO(),
+                                     stdout=io.StringIO())
+        CompleteLineTool.do_user.created = 0
+        rl.completion.append_character = " "
+
+    def test_complete_line(self):
+        self.assertEqual(self.tool.complete_line("us"), ["user"])
+        self.assertEqual(self.tool.complete_line("user add al"),
+                         ["albert", "alice"])
+        self.assertEqual(self.tool.complete_line("user ad alice", 7), ["add"])
+        self.assertEqual(self.tool.complete_line("user add ", 5),
+                         ["add", "list"])
+        self.assertEqual(self.tool.complete_line("nothing here"), [])
+        # readline is left alone
+        self.assertEqual(rl.completion.append_character, " ")
+
+    def test_limit(self):
+        self.tool.completion_limit = 1
+        self.assertEqual(self.tool.complete_line("user add "), ["albert"])
+        self.assertEqual(self.tool.stdout.getvalue(), "")
+
+    def test_complete_lines(self):
+        lines = ["user add al", ("user add bob", 10), "user add al",
+                 "user l", "user list ", "help us", ["user add ", 5]]
+        expected = [["albert", "alice"], ["bob"], ["albert", "alice"],
+                    ["list"], [], ["user"], ["add", "list"]]
+        self.assertEqual(self.tool.complete_lines(lines), expected)
+        # The user group is only looked up once
+        self.assertEqual(CompleteLineTool.do_user.created, 1)
+        pairs = [line if isinstance(line, (tuple, list)) else [line]
+                 for line in lines]
+        self.assertEqual([self.tool.complete_line(*pair) for pair in pairs],
+                         expected)
+
+
+class ExecuteTool(shellac.Shellac):
+
+    @staticmethod
+    def do_echo(args):
+        time.sleep(0.001)
+        print(args)
+
+    @staticmethod
+    def do_fail(args):
+        print("failing")
+        raise RuntimeError(args)
+
+    @staticmethod
+    @shellac.timeout(0.05)
+    def do_slow(args):
+        time.sleep(0.2)
+        print("late")
+
+
+class ExecuteTests(TestCase):
+
+    def setUp(self):
+        self.tool = ExecuteTool(stdin=io.StringIO(), stdout=io.StringIO())
+
+    def test_execute(self):
+        result = self.tool.execute("echo hello")
+        self.assertEqual(result.output, "hello\n")
+        self.assertIsNone(result.stop)
+        self.assertIsNone(result.error)
+        self.assertGreater(result.duration, 0)
+        self.assertTrue(self.tool.execute("exit").stop)
+        self.assertEqual(self.tool.stdout.getvalue(), "")
+
+    def test_error(self):
+        result = self.tool.execute("fail broken")
+        self.assertEqual(result.output, "failing\n")
+        self.assertIsInstance(result.error, RuntimeError)
+        self.assertEqual(str(result.error), "broken")
+
+    def test_macro(self):
+        self.tool.alias("both", "echo one; echo two")
+        self.assertEqual(self.tool.execute("both").output, "one\ntwo\n")
+
+    def test_concurrent(self):
+        results = {}
+
+        def run(i):
+            results[i] = [self.tool.execute("echo %d %d" % (i, n)).output
+                          for n in range(20)]
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(8):
+            self.assertEqual(results[i],
+                             ["%d %d\n" % (i, n) for n in range(20)])
+        buffers = self.tool.output_buffers.buffers
+        self.assertLessEqual(len(buffers), 8)
+        self.assertFalse(any(buf.getvalue() for buf in buffers))
+
+    def test_timeout(self):
+        pool = self.tool.output_buffers = shellac._BufferPool()
+        spare = io.StringIO()
+        pool.put(spare)
+        result = self.tool.execute("slow")
+        self.assertIn("Timed out", result.output)
+        # The buffer isn't reused while the command is still running
+        self.assertEqual(pool.buffers, [])
+        self.assertEqual(self.tool.execute("echo again").output, "again\n")
+        self.assertEqual(len(pool.buffers), 1)
+        self.assertIsNot(pool.buffers[0], spare)
+
 
 class UserGroupToolTests(TestCase):
 
@@ -90,14 +1788,26 @@ Press <TAB> (or type 'help <TAB>') to see what you can do..."""
         since there is a help_user method above."""
 
         @staticmethod
+        @shellac.warmable
         def list_users(token):
             return shellac.complete_list(myData.users.keys(), token)
         @staticmethod
+        @shellac.cached(ttl=60)
         def do_list(args):
             """Print a list of all users."""
             print(sorted(myData.users.keys()))
 
         @staticmethod
+        @shellac.invalidates(do_list)
+        def add_users(names):
+            """Add many users at once (used when running scripts)."""
+            for name in names:
+                myData.users[name] = ''
+            print("Added users: " + ', '.join(names))
+
+        @staticmethod
+        @shellac.batchable(add_users)
+        @shellac.invalidates(do_list)
         def do_add(args):
             """Add a new user."""
             myData.users[args] = ''
@@ -105,6 +1815,7 @@ Press <TAB> (or type 'help <TAB>') to see what you can do..."""
 
         @staticmethod
         @shellac.completer(list_users)
+        @shellac.invalidates(do_list)
         def do_remove(args):
             """Remove a user."""
             try:
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+"""
+Asynchronous writer
+===================
+
+A file writer which takes strings from a bounded in-memory queue and writes
+them to disk in batches from a background thread, so that callers never wait
+on disk I/O.
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+import traceback
+
+
+# Queued to tell the writer thread to finish
+_STOP = object()
+
+
+class AsyncWriter(object):
+    """Append strings to a file from a background thread.
+
+    Data is written whenever *batch_size* items are waiting, or
+    *flush_interval* seconds after the oldest unwritten item was queued.
+
+    :type path: string
+    :param path: File to append to.
+
+    :type maxsize: int
+    :param maxsize: Maximum number of items waiting to be written.
+
+    :type batch_size: int
+    :param batch_size: Number of items which triggers a write.
+
+    :type flush_interval: float
+    :param flush_interval: Maximum time (in seconds) an item waits before
+                           being written.
+
+    :type max_bytes: int
+    :param max_bytes: Rotate the file when it grows beyond this size
+                      (0 disables rotation).
+
+    :type backup_count: int
+    :param backup_count: Number of rotated files (path.1, path.2 ...) to keep.
+
+    :type block: boolean
+    :param block: If True, put() waits when the queue is full, otherwise the
+                  item is dropped and counted in *dropped*.
+    """
+
+    def __init__(self, path, maxsize=10000, batch_size=100,
+                 flush_interval=1.0, max_bytes=0, backup_count=5, block=True):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.block = block
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize)
+        self.out = open(path, 'a')
+        self.thread = threading.Thread(target=self._run,
+                                       name="AsyncWriter(%s)" % path)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, data):
+        """Queue a string to be written."""
+
+        try:
+            self.queue.put(data, self.block)
+        except queue.Full:
+            self.dropped += 1
+
+    def call(self, func):
+        """Queue a function to be called by the writer thread once
+        everything queued before it has been written.
+
+        The file is closed while func runs, so that func can replace it,
+        and is then reopened for appending.
+        """
+
+        self.queue.put(func)
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far has been written.
+
+        :type timeout: float
+        :param timeout: Maximum time to wait (in seconds).
+
+        :return: True if all data was written within the timeout
+        """
+
+        if not self.thread.is_alive():
+            return True
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        """Write everything queued and stop the writer thread."""
+
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+
+    def _run(self):
+        """Writer thread: collect items into batches and write them."""
+
+        batch = []
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self._write(batch)
+                deadline = None
+                continue
+            if item is _STOP or isinstance(item, threading.Event):
+                self._write(batch)
+                deadline = None
+                if item is _STOP:
+                    self.out.close()
+                    return
+                item.set()
+                continue
+            if callable(item):
+                self._write(batch)
+                deadline = None
+                self.out.close()
+                try:
+                    item()
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    self.out = open(self.path, 'a')
+                continue
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                deadline = None
+
+    def _write(self, batch):
+        """Write and clear a batch, rotating the file if required."""
+
+        if not batch:
+            return
+        self.out.write(''.join(batch))
+        self.out.flush()
+        del batch[:]
+        if self.max_bytes and self.out.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        """Rotate path to path.1, path.1 to path.2 and so on."""
+
+        self.out.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = "%s.%d" % (self.path, i)
+            if os.path.exists(src):
+                os.rename(src, "%s.%d" % (self.path, i + 1))
+        if self.backup_count:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self.out = open(self.path, 'a')
+